@@ -86,6 +86,7 @@ class PriceListAdmin(admin.ModelAdmin):
         return (
             super()
             .get_queryset(request)
+            .current()
             .select_related("product", "product__brand", "supplier")
         )
 
@@ -102,7 +103,7 @@ class PriceListAdmin(admin.ModelAdmin):
     get_brand.admin_order_field = "product__brand__name"
 
     def changelist_view(self, request, extra_context=None):
-        count = PriceList.objects.count()
+        count = PriceList.objects.current().count()
         if extra_context is None:
             extra_context = {}
 
@@ -0,0 +1,56 @@
+# Generated by Django 5.1.4 on 2026-10-17 22:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("perfume", "0012_alter_receiptitem_quantity_ordered_and_more"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="PriceFile",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "source",
+                    models.CharField(
+                        help_text="Имя файла без расширения",
+                        max_length=255,
+                        unique=True,
+                        verbose_name="Файл",
+                    ),
+                ),
+                ("sha256", models.CharField(max_length=64, verbose_name="SHA-256")),
+                (
+                    "context",
+                    models.CharField(
+                        help_text="Курс и версия справочника брендов, с которыми разбирался файл",
+                        max_length=255,
+                        verbose_name="Условия разбора",
+                    ),
+                ),
+                (
+                    "parsed",
+                    models.JSONField(
+                        blank=True, null=True, verbose_name="Результат разбора"
+                    ),
+                ),
+                ("updated", models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                "verbose_name": "Файл прайс-листа",
+                "verbose_name_plural": "Файлы прайс-листов",
+            },
+        ),
+    ]
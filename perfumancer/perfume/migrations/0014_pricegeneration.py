@@ -0,0 +1,50 @@
+# Generated by Django 5.1.4 on 2026-10-17 22:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("perfume", "0013_pricefile"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="PriceGeneration",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("created", models.DateTimeField(auto_now_add=True)),
+                (
+                    "published",
+                    models.BooleanField(default=False, verbose_name="Опубликовано"),
+                ),
+            ],
+            options={
+                "verbose_name": "Поколение прайс-листа",
+                "verbose_name_plural": "Поколения прайс-листа",
+            },
+        ),
+        migrations.AddField(
+            model_name="pricelist",
+            name="valid_from",
+            field=models.PositiveBigIntegerField(
+                db_index=True, default=0, verbose_name="Видна с поколения"
+            ),
+        ),
+        migrations.AddField(
+            model_name="pricelist",
+            name="valid_to",
+            field=models.PositiveBigIntegerField(
+                blank=True, db_index=True, null=True, verbose_name="Скрыта с поколения"
+            ),
+        ),
+    ]
@@ -7,7 +7,16 @@ from .order import (
     OrderStatus,
     Cabinet,
 )
-from .price_list import Supplier, Brand, Product, ProductBase, PriceList, CurrencyRate
+from .price_list import (
+    Supplier,
+    Brand,
+    Product,
+    ProductBase,
+    PriceList,
+    PriceFile,
+    PriceGeneration,
+    CurrencyRate,
+)
 from .receipt import Receipt, ReceiptItem, ReceiptStatus
 
 __all__ = [
@@ -18,6 +27,8 @@ __all__ = [
     "Product",
     "ProductBase",
     "PriceList",
+    "PriceFile",
+    "PriceGeneration",
     "CurrencyRate",
     "OrderProduct",
     "Customer",
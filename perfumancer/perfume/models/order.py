@@ -120,10 +120,12 @@ class Order(models.Model):
 
     def save(self, *args, **kwargs):
         if not self.pk:  # Only on creation
-            rate = CurrencyRate.objects.first()
-            if not rate:
+            # курс фиксируется в заказе, поэтому читается из базы, а не из
+            # кэша процесса, который может отставать от других процессов
+            rate = CurrencyRate.get_rate("USD", cached=False)
+            if rate is None:
                 raise ValidationError(_("Не установлен курс валюты"))
-            self.currency_rate = rate.rate
+            self.currency_rate = rate
         super().save(*args, **kwargs)
 
     class Meta:
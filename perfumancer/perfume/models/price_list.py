@@ -1,3 +1,4 @@
+from django.core.cache import cache
 from django.db import models
 from django.utils.translation import gettext_lazy as _, ngettext_lazy
 
@@ -88,6 +89,41 @@ class BrandAlias(models.Model):
         return self.name
 
 
+class PriceGeneration(models.Model):
+    """
+    Поколение общего прайс-листа. Обновление пишет строки под новым поколением,
+    а читатели видят только последнее опубликованное.
+    """
+
+    created = models.DateTimeField(auto_now_add=True)
+    published = models.BooleanField(default=False, verbose_name="Опубликовано")
+
+    class Meta:
+        verbose_name = "Поколение прайс-листа"
+        verbose_name_plural = "Поколения прайс-листа"
+
+    def __str__(self):
+        return f"Поколение {self.pk}"
+
+    @classmethod
+    def current_number(cls) -> int:
+        """Номер опубликованного поколения (0 — ни одного ещё не было)."""
+        published = cls.objects.filter(published=True)
+        return published.aggregate(number=models.Max("pk"))["number"] or 0
+
+
+class PriceListQuerySet(models.QuerySet):
+    def visible_in(self, generation: int):
+        return self.filter(
+            models.Q(valid_to__isnull=True) | models.Q(valid_to__gt=generation),
+            valid_from__lte=generation,
+        )
+
+    def current(self):
+        """Строки опубликованного поколения."""
+        return self.visible_in(PriceGeneration.current_number())
+
+
 class PriceList(models.Model):
     product = models.ForeignKey(
         ProductBase,
@@ -106,6 +142,19 @@ class PriceList(models.Model):
     price = models.DecimalField(
         max_digits=8, decimal_places=2, verbose_name="Цена", help_text="Цена товара"
     )
+    valid_from = models.PositiveBigIntegerField(
+        default=0,
+        db_index=True,
+        verbose_name="Видна с поколения",
+    )
+    valid_to = models.PositiveBigIntegerField(
+        blank=True,
+        null=True,
+        db_index=True,
+        verbose_name="Скрыта с поколения",
+    )
+
+    objects = PriceListQuerySet.as_manager()
 
     class Meta:
         unique_together = ("product", "supplier")
@@ -122,8 +171,41 @@ class PriceList(models.Model):
     get_brand.short_description = "Бренд"
 
 
+class PriceFile(models.Model):
+    """Последний разобранный файл поставщика: хэш содержимого и результат разбора."""
+
+    source = models.CharField(
+        max_length=255,
+        unique=True,
+        verbose_name="Файл",
+        help_text="Имя файла без расширения",
+    )
+    sha256 = models.CharField(max_length=64, verbose_name="SHA-256")
+    context = models.CharField(
+        max_length=255,
+        verbose_name="Условия разбора",
+        help_text="Курс и версия справочника брендов, с которыми разбирался файл",
+    )
+    parsed = models.JSONField(blank=True, null=True, verbose_name="Результат разбора")
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name = "Файл прайс-листа"
+        verbose_name_plural = "Файлы прайс-листов"
+
+    def __str__(self):
+        return self.source
+
+
 # простая модель для хранения курса валюты
 class CurrencyRate(models.Model):
+    # курсы для веб-запросов держатся в кэше; при изменении кэш сбрасывается.
+    # CACHES не настроен, поэтому кэш у каждого процесса свой (LocMemCache):
+    # сигнал сбрасывает его только в процессе, где сохранили курс, а остальные
+    # видят старый курс до CACHE_TTL
+    CACHE_KEY = "currency_rates"
+    CACHE_TTL = 60  # секунды
+
     currency = models.CharField(max_length=3, unique=True, verbose_name="Валюта")
     rate = models.DecimalField(max_digits=8, decimal_places=2, verbose_name="Курс")
 
@@ -131,5 +213,24 @@ class CurrencyRate(models.Model):
         verbose_name = "Курсы валют"
         verbose_name_plural = "Курс USD"
 
+    @classmethod
+    def get_rate(cls, currency="USD", cached=True):
+        """
+        Курс валюты (Decimal) из кэша или базы; None, если курс не задан.
+        С cached=False курс читается прямо из базы — для записей, где
+        устаревший курс недопустим.
+        """
+        if not cached:
+            return cls.objects.filter(currency=currency).values_list("rate", flat=True).first()
+        rates = cache.get(cls.CACHE_KEY)
+        if rates is None:
+            rates = dict(cls.objects.values_list("currency", "rate"))
+            cache.set(cls.CACHE_KEY, rates, cls.CACHE_TTL)
+        return rates.get(currency)
+
+    @classmethod
+    def clear_cache(cls):
+        cache.delete(cls.CACHE_KEY)
+
     def __str__(self):
         return f"Курс {self.currency}: {self.rate} RUB"  # Курс USD 120,00
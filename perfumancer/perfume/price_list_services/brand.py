@@ -1,4 +1,10 @@
-from thefuzz import process, fuzz
+import re
+from collections import OrderedDict
+from typing import Iterable, NamedTuple
+
+import numpy as np
+import pandas as pd
+from rapidfuzz import process, fuzz, utils
 
 unique_brands = {
     "10 avenue",
@@ -1098,16 +1104,168 @@ unique_brands.update(new_brands_from_list_5)
 brand_synonyms.update(new_brand_synonyms_from_list_5)
 
 
+# Индекс «синоним в нижнем регистре → стандартное название бренда».
+# Строится лениво и пересобирается только при изменении справочников.
+_synonym_index: dict[str, str] = {}
+_synonym_index_key = None
+
+
+def _brand_dictionaries_key() -> tuple[int, int]:
+    """Дешёвый ключ версии справочников брендов."""
+    return len(brand_synonyms), len(unique_brands)
+
+
+def reset_brand_index() -> None:
+    """
+    Сбрасывает индекс синонимов. Нужен, если справочники правятся на месте
+    (например, добавлен синоним в существующий список) и размер не изменился.
+    """
+    global _synonym_index_key, _alias_trie_key, _alias_patterns_key
+    _synonym_index_key = None
+    _alias_trie_key = None
+    _alias_patterns_key = None
+
+
+def get_synonym_index() -> dict[str, str]:
+    """
+    Возвращает индекс синонимов. При совпадении синонима у нескольких брендов
+    побеждает первый по порядку brand_synonyms — как и при линейном поиске.
+    """
+    global _synonym_index, _synonym_index_key
+
+    key = _brand_dictionaries_key()
+    if key != _synonym_index_key:
+        index = {}
+        for standard, synonyms in brand_synonyms.items():
+            for synonym in synonyms:
+                index.setdefault(synonym.lower(), standard)
+        _synonym_index = index
+        _synonym_index_key = key
+    return _synonym_index
+
+
+class BrandCacheInfo(NamedTuple):
+    hits: int
+    misses: int
+    maxsize: int
+    currsize: int
+
+
+class BrandResolver:
+    """
+    Приводит названия брендов из заголовков прайс-листов к стандартным.
+
+    Сначала ищет точный синоним, затем — ближайший бренд из unique_brands
+    по fuzz.ratio (как thefuzz.process.extractOne). Нечёткий поиск для всех
+    новых строк выполняется одним вызовом rapidfuzz.process.cdist, а
+    результаты запоминаются в LRU-кэше по названию в нижнем регистре.
+    """
+
+    def __init__(self, maxsize: int = 4096, workers: int = -1):
+        self.maxsize = maxsize
+        # потоки rapidfuzz.process.cdist; -1 — по числу ядер
+        self.workers = workers
+        self.hits = 0
+        self.misses = 0
+        self._cache: OrderedDict[tuple[str, int], str] = OrderedDict()
+        self._choices: list[str] = []
+        self._processed_choices: list[str] = []
+        self._choices_key = None
+
+    def cache_info(self) -> BrandCacheInfo:
+        return BrandCacheInfo(self.hits, self.misses, self.maxsize, len(self._cache))
+
+    def cache_clear(self) -> None:
+        self._cache.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def _refresh_choices(self) -> None:
+        """Пересобирает массив вариантов, если справочники изменились."""
+        key = _brand_dictionaries_key()
+        if key == self._choices_key:
+            return
+        # Порядок совпадает с порядком обхода множества в thefuzz,
+        # поэтому при равных оценках выбирается тот же бренд.
+        self._choices = list(unique_brands)
+        self._processed_choices = [utils.default_process(c) for c in self._choices]
+        self._choices_key = key
+        self._cache.clear()
+
+    def _remember(self, key: tuple[str, int], value: str) -> None:
+        self._cache[key] = value
+        if len(self._cache) > self.maxsize:
+            self._cache.popitem(last=False)
+
+    def resolve(self, brand: str, threshold: int = 50) -> str:
+        return self.resolve_many([brand], threshold)[brand]
+
+    def resolve_many(self, brands: Iterable[str], threshold: int = 50) -> dict[str, str]:
+        """Возвращает словарь «исходное название → стандартный бренд»."""
+        self._refresh_choices()
+        synonym_index = get_synonym_index()
+
+        result = {}
+        pending: dict[str, list[str]] = {}
+        for brand in brands:
+            if brand in result:
+                continue
+            key = (brand.lower(), threshold)
+            cached = self._cache.get(key)
+            if cached is not None:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                result[brand] = cached
+                continue
+
+            # Проверяем точное соответствие
+            standard = synonym_index.get(key[0])
+            if standard is not None:
+                self.misses += 1
+                self._remember(key, standard)
+                result[brand] = standard
+            else:
+                pending.setdefault(key[0], []).append(brand)
+
+        if pending and self._choices:
+            # Ищем близкое совпадение сразу для всех новых названий
+            queries = list(pending)
+            scores = process.cdist(
+                [utils.default_process(q) for q in queries],
+                self._processed_choices,
+                scorer=fuzz.ratio,
+                dtype=np.float64,
+                workers=self.workers,
+            )
+            best = scores.argmax(axis=1)
+            for row, query in enumerate(queries):
+                score = round(scores[row, best[row]])
+                for brand in pending[query]:
+                    standard = (
+                        self._choices[best[row]] if score >= threshold else brand.upper()
+                    )
+                    self.misses += 1
+                    self._remember((query, threshold), standard)
+                    result[brand] = standard
+        else:
+            for brands_group in pending.values():
+                for brand in brands_group:
+                    self.misses += 1
+                    result[brand] = brand.upper()
+
+        return result
+
+
+brand_resolver = BrandResolver()
+
+
 def get_standard_brand_fuzzy(brand, threshold=50):
-    # Проверяем точное соответствие
-    for standard, synonyms in brand_synonyms.items():
-        if brand.lower() in [s.lower() for s in synonyms]:
-            return standard
-    # Ищем близкое совпадение
-    match = process.extractOne(brand, unique_brands, scorer=fuzz.ratio)
-    if match and match[1] >= threshold:
-        return match[0]
-    return brand.upper()
+    return brand_resolver.resolve(brand, threshold)
+
+
+def resolve_brands(brands: Iterable[str], threshold: int = 50) -> dict[str, str]:
+    """Пакетный вариант get_standard_brand_fuzzy для всех заголовков прайса."""
+    return brand_resolver.resolve_many(brands, threshold)
 
 
 def get_brand_aliases(brand) -> tuple[str]:
@@ -1117,6 +1275,33 @@ def get_brand_aliases(brand) -> tuple[str]:
         return tuple()
 
 
+# Скомпилированные регулярки алиасов по брендам; пересобираются вместе с индексом
+_alias_patterns: dict[str, re.Pattern | None] = {}
+_alias_patterns_key = None
+
+
+def get_brand_alias_pattern(brand) -> re.Pattern | None:
+    """
+    Альтернатива всех алиасов бренда (get_brand_aliases) в нижнем регистре:
+    search() находит, есть ли в названии хоть один из них. None, если
+    алиасов нет. Компилируется один раз на бренд.
+    """
+    global _alias_patterns, _alias_patterns_key
+
+    key = _brand_dictionaries_key()
+    if key != _alias_patterns_key:
+        _alias_patterns = {}
+        _alias_patterns_key = key
+    if brand not in _alias_patterns:
+        aliases = get_brand_aliases(brand)
+        _alias_patterns[brand] = (
+            re.compile("|".join(re.escape(alias.lower()) for alias in aliases))
+            if aliases
+            else None
+        )
+    return _alias_patterns[brand]
+
+
 # Fixed version - get all brand aliases
 def get_all_brand_aliases() -> set[str]:
     # Start with all unique brands in lowercase
@@ -1135,6 +1320,53 @@ def get_all_brand_aliases() -> set[str]:
 ALIASES = sorted(get_all_brand_aliases(), key=len, reverse=True)
 
 
+# Префиксное дерево алиасов: узел — словарь «символ → узел», под ключом
+# _TRIE_END хранится пара (алиас, бренд), если на узле заканчивается алиас.
+_TRIE_END = None
+_alias_trie: dict = {}
+_alias_trie_key = None
+
+
+def get_alias_trie() -> dict:
+    """
+    Возвращает префиксное дерево по всем алиасам (ALIASES). Владелец алиаса
+    определяется так же, как раньше: сначала первый бренд из brand_synonyms,
+    затем бренд из unique_brands с тем же написанием.
+    """
+    global _alias_trie, _alias_trie_key
+
+    key = _brand_dictionaries_key()
+    if key != _alias_trie_key:
+        owners = dict(get_synonym_index())
+        for brand in unique_brands:
+            owners.setdefault(brand.lower(), brand)
+
+        trie = {}
+        for alias, brand in owners.items():
+            node = trie
+            for char in alias:
+                node = node.setdefault(char, {})
+            node[_TRIE_END] = (alias, brand)
+        _alias_trie = trie
+        _alias_trie_key = key
+    return _alias_trie
+
+
+def match_brand_prefix(text: str) -> tuple[str, str] | None:
+    """
+    Находит самый длинный алиас, с которого начинается text (в нижнем
+    регистре), за один проход по строке. Возвращает (алиас, бренд) или None.
+    """
+    node = get_alias_trie()
+    match = node.get(_TRIE_END)
+    for char in text:
+        node = node.get(char)
+        if node is None:
+            break
+        match = node.get(_TRIE_END, match)
+    return match
+
+
 # Fixed version - check if string starts with a brand or alias
 def get_brand_from_name(string: str) -> str:
     # Convert string to lowercase for case-insensitive comparison
@@ -1142,20 +1374,15 @@ def get_brand_from_name(string: str) -> str:
 
     string_lower = string_lower.replace("fragrance world ", "").strip()
     string_lower = string_lower.replace("\xa0", " ").strip()
-    # Get all aliases and sort by length (descending) to match longer aliases first
-    # if band:
-    #     print(ALIASES)
-    for alias in ALIASES:
-        if string_lower.startswith(alias):
-
-            # Find the original brand for this alias
-            for brand, synonyms in brand_synonyms.items():
-                if alias.lower() in [s.lower() for s in synonyms]:
-                    return brand
-
-            # If the alias is one of the unique brands
-            for brand in unique_brands:
-                if brand.lower() == alias.lower():
-                    return brand
-
-    return "NAN"
+
+    match = match_brand_prefix(string_lower)
+    return match[1] if match else "NAN"
+
+
+def brands_from_names(names: pd.Series) -> pd.Series:
+    """
+    Колоночный вариант get_brand_from_name: каждое уникальное название
+    разбирается один раз, результат раскладывается обратно по строкам.
+    """
+    brands = {name: get_brand_from_name(name) for name in names.unique()}
+    return names.map(brands)
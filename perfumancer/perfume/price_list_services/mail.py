@@ -1,72 +1,399 @@
 import os
 import asyncio
 from collections import defaultdict
-import imaplib
+from contextlib import asynccontextmanager
+import base64
+import binascii
 import email
+import hashlib
+import json
 import re
 from email.header import decode_header
-from email.utils import parseaddr
+from email.utils import decode_rfc2231, parseaddr, parsedate_to_datetime
 from datetime import datetime, timedelta
 import logging
+import shutil
 import aiofiles
+import aioimaplib
 from functools import wraps
+from itertools import takewhile
 import time
 from concurrent.futures import ThreadPoolExecutor
-from typing import List, Dict
+from typing import List, Dict, NamedTuple, Optional
+from urllib.parse import unquote_to_bytes
+
+from .mail_metrics import MailMetrics, report_mail_metrics
 
 logger = logging.getLogger(__name__)
 
-BATCH_SIZE = 10
+# Писем в одном запросе BODYSTRUCTURE и заголовков
+BATCH_SIZE = int(os.getenv("MAIL_FETCH_BATCH_SIZE", "10"))
 MAX_WORKERS = 4
 RETRY_ATTEMPTS = 3
-PROCESSED_EMAILS = set()
+RETRY_DELAY = 1  # секунды, умножаются на номер попытки
+IMAP_TIMEOUT = 20  # секунды без данных от сервера
+# Последний обработанный UID по ящикам; лежит рядом с сохранёнными прайсами
+MAIL_STATE_FILE = ".mail_state.json"
+# Кэш вложений: файлы по sha256 содержимого и манифест «поставщик → файл»
+BLOB_DIR = ".blobs"
+MANIFEST_FILE = ".manifest.json"
+PRICE_FILE_EXTENSIONS = (".xls", ".xlsx")
+
+# Ошибки, после которых соединение считается сломанным и открывается заново
+CONNECTION_ERRORS = (
+    asyncio.TimeoutError,
+    aioimaplib.CommandTimeout,
+    aioimaplib.Abort,
+    OSError,
+)
+
+# Размер куска при скачивании вложения (до декодирования)
+FETCH_CHUNK_SIZE = 1024 * 1024
+PARTIAL_SUFFIX = ".part"
+
+FETCH_RESPONSE_RE = re.compile(rb"^\d+ FETCH \(")
+UIDVALIDITY_RE = re.compile(rb"\[UIDVALIDITY (\d+)\]")
+FETCH_TOKEN_RE = re.compile(
+    rb'\s*(?:(?P<open>\()|(?P<close>\))|"(?P<quoted>(?:[^"\\]|\\.)*)"'
+    rb'|\{(?P<literal>\d+)\}$|(?P<atom>[^\s()"\[]+(?:\[[^\]]*\])?(?:<\d+>)?))'
+)
+QUOTED_ESCAPE_RE = re.compile(rb"\\(.)")
+
+# Письма-не прайсы: слова в теме или имени вложения (накладные). По теме и по
+# отправителям из MAIL_EXCLUDED_SENDERS письма отсекаются ещё поиском на сервере
+EXCLUDED_SUBJECT_WORDS = ("накла",)
+EXCLUDED_SENDERS = [
+    sender.strip().lower()
+    for sender in os.getenv("MAIL_EXCLUDED_SENDERS", "").split(",")
+    if sender.strip()
+]
+
+EXCEL_MIME_TYPES = {
+    "application/vnd.ms-excel",
+    "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+}
 
 
 class IMAPConnectionPool:
-    def __init__(self, host, username, password, pool_size=2):
+    """
+    Пул соединений aioimaplib. Соединения открываются по требованию, но не
+    больше pool_size одновременно: команды сверх лимита ждут на семафоре.
+    Замеры обхода почты копятся в metrics.
+    """
+
+    def __init__(self, host, username, password, pool_size=MAX_WORKERS, mailbox="INBOX"):
         self.host = host
         self.username = username
         self.password = password
         self.pool_size = pool_size
+        self.mailbox = mailbox
         self.connections = asyncio.Queue()
+        self.semaphore = asyncio.Semaphore(pool_size)
+        self.uidvalidity = None
+        self.metrics = MailMetrics()
 
-    async def get_active_connection(self):
-        """Get an active IMAP connection from the pool"""
-        return await self.get_connection()
+    @property
+    def key(self):
+        """Ключ ящика в файле состояния."""
+        return f"{self.username}@{self.host}/{self.mailbox}"
 
     async def __aenter__(self):
-        for _ in range(self.pool_size):
-            conn = await self._create_connection()
-            await self.connections.put(conn)
         return self
 
     async def __aexit__(self, exc_type, exc_val, exc_tb):
         while not self.connections.empty():
-            conn = await self.connections.get()
+            conn = self.connections.get_nowait()
             await self._close_connection(conn)
 
-    async def get_connection(self):
-        return await self.connections.get()
-
-    async def release_connection(self, conn):
-        await self.connections.put(conn)
+    @asynccontextmanager
+    async def connection(self):
+        """
+        Выдаёт соединение на время блока. В пул оно возвращается, только если
+        блок завершился без ошибки: после любой ошибки (обрыв, ошибка
+        протокола, отмена задачи) состояние соединения неизвестно, и оно
+        закрывается.
+        """
+        async with self.semaphore:
+            if self.connections.empty():
+                conn = await self._create_connection()
+            else:
+                conn = self.connections.get_nowait()
+            try:
+                yield conn
+            except BaseException:
+                await self._close_connection(conn)
+                raise
+            else:
+                self.connections.put_nowait(conn)
+
+    async def execute(self, command, *args, metric=None, **labels):
+        """
+        Выполняет команду aioimaplib (например, "uid_search" или "uid") на
+        свободном соединении. При обрыве соединение переоткрывается, и команда
+        повторяется до RETRY_ATTEMPTS раз.
+
+        :param metric: имя метрики длительности команды (с метками labels).
+            Замеряется только сама команда, без ожидания свободного
+            соединения, подключения и пауз между попытками.
+        """
+        for attempt in range(1, RETRY_ATTEMPTS + 1):
+            try:
+                async with self.connection() as conn:
+                    if metric is None:
+                        return await getattr(conn, command)(*args)
+                    with self.metrics.timer(metric, **labels):
+                        return await getattr(conn, command)(*args)
+            except CONNECTION_ERRORS as e:
+                if attempt == RETRY_ATTEMPTS:
+                    raise
+                logger.warning(
+                    "Ошибка соединения с IMAP (%s: %s), попытка %s из %s",
+                    type(e).__name__, e, attempt, RETRY_ATTEMPTS,
+                )
+                await asyncio.sleep(RETRY_DELAY * attempt)
 
     async def _create_connection(self):
-        conn = await asyncio.to_thread(imaplib.IMAP4_SSL, self.host)
-        await asyncio.to_thread(conn.login, self.username, self.password)
-        await asyncio.to_thread(conn.select, "INBOX")  # Select INBOX during connection setup
+        conn = aioimaplib.IMAP4_SSL(self.host, timeout=IMAP_TIMEOUT)
+        try:
+            with self.metrics.timer("mail_connect_seconds"):
+                await conn.wait_hello_from_server()
+            with self.metrics.timer("mail_login_seconds"):
+                response = await conn.login(self.username, self.password)
+                if response.result != "OK":
+                    raise aioimaplib.Error(f"Ошибка авторизации: {response.lines}")
+                response = await conn.select(self.mailbox)
+                if response.result != "OK":
+                    raise aioimaplib.Error(f"Не удалось открыть {self.mailbox}: {response.lines}")
+            for line in response.lines:
+                match = UIDVALIDITY_RE.search(line)
+                if match:
+                    self.uidvalidity = int(match.group(1))
+        except BaseException:
+            await self._close_connection(conn)
+            raise
         return conn
 
     async def _close_connection(self, conn):
         try:
-            await asyncio.to_thread(conn.close)
-            await asyncio.to_thread(conn.logout)
-        except:
+            await conn.logout()
+        except Exception:
             pass
 
 
-async def start_server_email_standalone():
-    """Отдельная функция работы с почтой"""
+def group_fetch_responses(lines):
+    """
+    Группирует строки ответа FETCH aioimaplib по письмам: строка "N FETCH (...",
+    за которой идут литералы (bytearray) и продолжения строки.
+    """
+    groups = []
+    for line in lines:
+        if isinstance(line, bytes) and FETCH_RESPONSE_RE.match(line):
+            groups.append([line])
+        elif groups:
+            groups[-1].append(line)
+    # последняя строка — статус завершения команды
+    if groups and isinstance(groups[-1][-1], bytes) and not groups[-1][-1].endswith(b")"):
+        groups[-1].pop()
+    return groups
+
+
+_OPEN, _CLOSE = object(), object()
+
+
+def _fetch_tokens(response_part):
+    """
+    Токены ответа FETCH: "(", ")", строки (str), литералы (bytearray), атомы (str)
+    и None для NIL. Скобки отдаются отдельными объектами, чтобы не путать их
+    со строками "(" и ")".
+    """
+    pieces = iter(response_part)
+    for piece in pieces:
+        if isinstance(piece, bytearray):
+            yield piece
+            continue
+        pos = 0
+        while pos < len(piece):
+            match = FETCH_TOKEN_RE.match(piece, pos)
+            if not match:
+                if piece[pos:].strip():
+                    raise ValueError(f"Не удалось разобрать ответ FETCH: {piece[pos:pos + 50]!r}")
+                break
+            pos = match.end()
+            if match["open"]:
+                yield _OPEN
+            elif match["close"]:
+                yield _CLOSE
+            elif match["quoted"] is not None:
+                yield QUOTED_ESCAPE_RE.sub(rb"\1", match["quoted"]).decode("utf-8", "replace")
+            elif match["literal"] is not None:
+                yield next(pieces)
+            else:
+                atom = match["atom"].decode("utf-8", "replace")
+                yield None if atom.upper() == "NIL" else atom
+
+
+def parse_fetch_response(response_part):
+    """
+    Разбирает ответ FETCH одного письма в словарь "UID" → "5",
+    "BODYSTRUCTURE" → вложенные списки, "BODY[2]" → bytearray и т.д.
+    """
+    stack = [[]]
+    for token in _fetch_tokens(response_part):
+        if token is _OPEN:
+            stack.append([])
+        elif token is _CLOSE:
+            items = stack.pop()
+            stack[-1].append(items)
+        else:
+            stack[-1].append(token)
+    # ["5", "FETCH", [имя, значение, имя, значение, ...]]
+    items = stack[0][2]
+    return {name.upper(): value for name, value in zip(items[::2], items[1::2])}
+
+
+class BodyPart(NamedTuple):
+    """Листовая часть письма из BODYSTRUCTURE."""
+
+    section: str  # номер секции для BODY[...], например "2" или "1.3"
+    mime_type: str
+    filename: Optional[str]  # уже раскодированное имя файла
+    size: Optional[int]  # размер в кодировке передачи, байт
+    encoding: str  # Content-Transfer-Encoding
+    disposition: Optional[str]
+
+    @property
+    def is_excel_attachment(self):
+        if self.disposition != "attachment" or not self.filename:
+            return False
+        return self.mime_type in EXCEL_MIME_TYPES or self.filename.lower().endswith((".xls", ".xlsx"))
+
+
+def parse_bodystructure(structure):
+    """
+    Раскладывает разобранный BODYSTRUCTURE (вложенные списки из
+    parse_fetch_response) в список BodyPart в порядке секций.
+    Обход идёт по явному стеку, без рекурсии.
+    """
+    parts = []
+    stack = [(structure, "")]
+    while stack:
+        node, section = stack.pop()
+        if not isinstance(node, list) or not node:
+            continue
+
+        if isinstance(node[0], list):
+            # multipart: сначала вложенные части, затем подтип и параметры
+            children = list(takewhile(lambda child: isinstance(child, list), node))
+            for number in range(len(children), 0, -1):
+                stack.append((children[number - 1], f"{section}.{number}".lstrip(".")))
+            continue
+
+        section = section or "1"
+        mime_type = f"{node[0]}/{node[1] if len(node) > 1 else ''}".lower()
+        if mime_type == "message/rfc822" and len(node) > 8 and isinstance(node[8], list):
+            # вложенное письмо: его части нумеруются внутри секции письма
+            inner = node[8]
+            stack.append((inner, section if inner and isinstance(inner[0], list) else f"{section}.1"))
+            continue
+
+        params = _decode_params(node[2] if len(node) > 2 else None)
+        # после обязательных полей: строки для text/*, затем md5 и disposition
+        disposition_index = 9 if mime_type.startswith("text/") else 8
+        disposition = node[disposition_index] if len(node) > disposition_index else None
+        disposition_type, disposition_params = None, {}
+        if isinstance(disposition, list) and disposition and isinstance(disposition[0], str):
+            disposition_type = disposition[0].lower()
+            disposition_params = _decode_params(disposition[1] if len(disposition) > 1 else None)
+
+        filename = disposition_params.get("filename") or params.get("name")
+        size = node[6] if len(node) > 6 else None
+        parts.append(BodyPart(
+            section=section,
+            mime_type=mime_type,
+            filename=clean_header(filename),
+            size=int(size) if isinstance(size, str) and size.isdigit() else None,
+            encoding=(node[5] if len(node) > 5 and isinstance(node[5], str) else "7bit").lower(),
+            disposition=disposition_type,
+        ))
+    return parts
+
+
+def _decode_params(params):
+    """
+    Список параметров BODYSTRUCTURE в словарь. Параметры по RFC 2231
+    (filename*, filename*0*, filename*1 ...) собираются и раскодируются.
+    """
+    if not isinstance(params, list):
+        return {}
+    result = {}
+    continuations = defaultdict(list)
+    for name, value in zip(params[::2], params[1::2]):
+        if not isinstance(name, str) or value is None:
+            continue
+        if isinstance(value, bytearray):
+            value = bytes(value).decode("utf-8", "replace")
+        name = name.lower()
+        if "*" in name:
+            base, _, number = name.partition("*")
+            number = number.rstrip("*")
+            continuations[base].append((int(number) if number.isdigit() else 0, name.endswith("*"), value))
+        else:
+            result[name] = value
+
+    for base, pieces in continuations.items():
+        pieces.sort(key=lambda piece: piece[0])
+        charset, data = "utf-8", b""
+        for number, encoded, value in pieces:
+            if encoded:
+                if number == 0:
+                    value_charset, _, value = decode_rfc2231(value)
+                    charset = value_charset or charset
+                data += unquote_to_bytes(value)
+            else:
+                data += value.encode(charset, "replace")
+        try:
+            result[base] = data.decode(charset, "replace")
+        except LookupError:
+            result[base] = data.decode("utf-8", "replace")
+    return result
+
+
+class TransferDecoder:
+    """Потоковое декодирование Content-Transfer-Encoding кусками."""
+
+    def __init__(self, encoding):
+        self.encoding = (encoding or "7bit").lower()
+        self.tail = b""
+
+    def feed(self, chunk: bytes) -> bytes:
+        if self.encoding == "base64":
+            data = self.tail + b"".join(chunk.split())
+            cut = len(data) - len(data) % 4
+            self.tail = data[cut:]
+            return base64.b64decode(data[:cut])
+        if self.encoding == "quoted-printable":
+            data = self.tail + chunk
+            cut = data.rfind(b"\n") + 1
+            self.tail = data[cut:]
+            return binascii.a2b_qp(data[:cut])
+        return chunk
+
+    def flush(self) -> bytes:
+        tail, self.tail = self.tail, b""
+        if self.encoding == "base64":
+            return base64.b64decode(tail + b"=" * (-len(tail) % 4)) if tail else b""
+        if self.encoding == "quoted-printable":
+            return binascii.a2b_qp(tail)
+        return tail
+
+
+async def start_server_email_standalone(days=8, on_saved=None):
+    """
+    Отдельная функция работы с почтой.
+
+    :param on_saved: вызывается с (путь, sha256) для каждого прайса, чьё
+        содержимое обновилось, сразу после его сохранения
+    """
     logger.info("Сервер запущен!")
 
     pool = IMAPConnectionPool(
@@ -74,35 +401,98 @@ async def start_server_email_standalone():
         os.getenv("USERNAME_EMAIL"),
         os.getenv("PASSWORD_EMAIL")
     )
+    dir_path = get_save_dir()
+    mail_state = load_json(os.path.join(dir_path, MAIL_STATE_FILE))
+    manifest = load_json(os.path.join(dir_path, MANIFEST_FILE))
 
-    async with pool as imap:
+    async with pool:
         try:
-            conn = await pool.get_active_connection()
-            try:
-                logger.info("Аутентификация прошла успешно!")
-                emails = await fetch_emails_with_excel_attachments_async(conn, days=8)
-                logger.info(f"Найдено {len(emails)} писем с прайсами")
-
-                if emails:
-                    logger.info("Начинаем сохранение вложений...")
-                    await save_attachments_async(conn, emails)
-
-                    for email_data in emails:
-                        logger.debug("Письмо от %s (%s) с темой %s, вложение: %s",
-                                     email_data["name"], email_data["address"],
-                                     email_data["subject"], email_data["files"])
-                else:
-                    logger.info("Нет писем с вложениями Excel за последние 1 день.")
-            finally:
-                await pool.release_connection(conn)
+            await pool.execute("noop")  # первое соединение сообщает UIDVALIDITY
+            # без манифеста неизвестно, чьи прайсы лежат в каталоге: смотрим всё
+            mailbox_state = mail_state.get(pool.key, {}) if manifest else {}
+            last_uid = None
+            if mailbox_state.get("uidvalidity") == pool.uidvalidity:
+                last_uid = mailbox_state.get("last_uid")
+            elif mailbox_state:
+                logger.info("UIDVALIDITY ящика изменился, просматриваем почту заново")
+
+            uids = await search_email_uids(pool, days, last_uid)
+            if uids is None:
+                return
+
+            emails = await fetch_emails_with_excel_attachments_async(pool, uids)
+            if emails is None:
+                return
+            logger.info(f"Найдено {len(emails)} писем с прайсами")
+
+            if emails:
+                logger.info("Начинаем сохранение вложений...")
+                saved = await save_attachments_async(pool, emails, dir_path, manifest, on_saved)
+                # манифест описывает то, что уже лежит на диске, даже при ошибке
+                save_json(os.path.join(dir_path, MANIFEST_FILE), manifest)
+                if not saved:
+                    # UID не сдвигаем: в следующий раз письма скачаются снова
+                    return
+
+                for email_data in emails:
+                    logger.debug("Письмо от %s (%s) с темой %s, вложение: %s",
+                                 email_data["name"], email_data["address"],
+                                 email_data["subject"], email_data["files"])
+            elif last_uid is None:
+                logger.info("Нет писем с вложениями Excel за последние %s дней.", days)
+            else:
+                logger.info("Новых писем с вложениями Excel нет.")
+
+            if (emails or last_uid is not None) and os.path.isdir(dir_path):
+                # при полном просмотре выбывают и поставщики, чьих писем не нашлось
+                seen = None if last_uid is not None else {
+                    email_data["address"].lower() for email_data in emails
+                }
+                await asyncio.to_thread(remove_stale_price_files, dir_path, manifest, days, seen)
+                save_json(os.path.join(dir_path, MANIFEST_FILE), manifest)
+
+            if uids:
+                mail_state[pool.key] = {"uidvalidity": pool.uidvalidity, "last_uid": max(uids)}
+                save_json(os.path.join(dir_path, MAIL_STATE_FILE), mail_state)
         except Exception as e:
             logger.error(f"Неожиданная ошибка: {e}")
             raise
+        finally:
+            report_mail_metrics(pool.metrics, dir_path)
+
+
+def get_save_dir():
+    return "../" + os.getenv("SAVE_DIR")
 
 
-async def async_file_write(file_path: str, data: bytes):
-    async with aiofiles.open(file_path, mode='wb') as f:
-        await f.write(data)
+def load_json(file_path):
+    """Читает служебный JSON (состояние ящиков, манифест); при отсутствии или порче файла — пусто."""
+    try:
+        with open(file_path, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_json(file_path, data):
+    """Атомарно записывает служебный JSON через временный файл."""
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    with open(file_path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(file_path + ".tmp", file_path)
+
+
+def get_price_file_hashes(dir_path):
+    """
+    sha256 прайсов по манифесту вложений: {имя файла: хэш}. Попадают только
+    файлы, чей размер и время изменения совпадают с записанными при
+    сохранении, — остальные вызывающему придётся хэшировать самому.
+    """
+    return {
+        entry["file"]: entry["sha256"]
+        for entry in load_json(os.path.join(dir_path, MANIFEST_FILE)).values()
+        if is_manifest_entry_intact(dir_path, entry)
+    }
 
 
 def clean_header(header_value):
@@ -119,214 +509,490 @@ def clean_header(header_value):
     return result
 
 
-def extract_excel_attachments_from_bodystructure(bodystructure):
-    """Извлечение имен Excel-вложений из строки BODYSTRUCTURE."""
-    attachments = []
-
-    # Расширенный паттерн для поиска Excel-вложений
-    excel_patterns = [
-        # Стандартный паттерн для обычных Excel-файлов
-        r'\("application" "vnd\.(ms-excel|openxmlformats-officedocument\.spreadsheetml\.sheet)".*?\("attachment" \("filename" "(.*?)"\)\)',
+def extract_excel_attachments_from_bodystructure(structure):
+    """Excel-вложения письма (список BodyPart) по разобранному BODYSTRUCTURE."""
+    return [part for part in parse_bodystructure(structure) if part.is_excel_attachment]
 
-        # Альтернативный паттерн для других возможных форматов
-        r'\("application" "octet-stream".*?\("attachment" \("filename" "(.*?\.xlsx?)"\)\)',
 
-        # Паттерн для поиска по расширению файла
-        r'\("attachment".*?\("filename" "(.*?\.xlsx?)"\)\)'
-    ]
-
-    for pattern in excel_patterns:
-        if pattern.endswith('xlsx?)"\)\)'):
-            # Для паттернов, где ищем по расширению, извлекаем только имя файла
-            matches = re.findall(pattern, bodystructure, re.IGNORECASE)
-            for filename in matches:
-                if filename.lower().endswith(('.xls', '.xlsx')):
-                    attachments.append(clean_header(filename))
-        else:
-            # Для остальных паттернов
-            matches = re.findall(pattern, bodystructure, re.IGNORECASE)
-            for items in matches:
-                if isinstance(items, tuple):
-                    # Если найдено несколько групп захвата
-                    filename = items[-1]  # Берем последний элемент (имя файла)
-                    attachments.append(clean_header(filename))
-                else:
-                    # Если найдена только одна группа
-                    attachments.append(clean_header(items))
-
-    # Удаляем дубликаты
-    return list(dict.fromkeys(attachments))
+def is_excluded_message(message):
+    """Накладная или письмо исключённого отправителя — не прайс."""
+    if message["address"].lower() in EXCLUDED_SENDERS:
+        return True
+    texts = [message.get("subject", "").lower()] + [file.lower() for file in message.get("files", [])]
+    return any(word in text for word in EXCLUDED_SUBJECT_WORDS for text in texts)
 
 
 def filter_message(messages_data):
     """
     Фильтрует сообщения и оставляет только самое последнее с Excel-вложением
     от каждого отправителя.
+
+    Основной отбор делает сервер (search_email_criteria) и выборка
+    fetch_emails_with_excel_attachments_async; здесь — страховка на случай,
+    если сервер исключения не понял.
     """
-    # Первый этап - отфильтровываем ненужные сообщения
-    filtered_messages = []
+    latest_messages = {}
     for message in messages_data:
-        if not message.get("subject"):
-            continue
-        if 'накла' in message.get("subject", "").lower():
+        if not message.get("subject") or is_excluded_message(message):
             continue
-        if any('накла' in file.lower() for file in message.get("files", [])):
-            continue
-        filtered_messages.append(message)
 
-    # Группируем по адресу отправителя и оставляем только самое свежее сообщение
-    latest_messages = {}
-    for message in filtered_messages:
+        # свежее — по дате письма, без даты или при равенстве — по UID
         address = message["address"].lower()
-
-        # Если адрес уже встречался, сравниваем даты
-        if address in latest_messages:
-            try:
-                # Пытаемся преобразовать строки дат в datetime объекты для корректного сравнения
-                current_date = email.utils.parsedate_to_datetime(message["date"])
-                saved_date = email.utils.parsedate_to_datetime(latest_messages[address]["date"])
-
-                # Если текущее сообщение новее, заменяем сохраненное
-                if current_date > saved_date:
-                    latest_messages[address] = message
-            except:
-                # Если не получается преобразовать даты, просто заменяем
-                # (предполагая, что сообщения отсортированы по дате)
-                latest_messages[address] = message
-        else:
-            # Если это первое сообщение от данного отправителя, сохраняем его
+        saved = latest_messages.get(address)
+        if saved is None or message_order(message) > message_order(saved):
             latest_messages[address] = message
 
-    # Преобразуем словарь обратно в список и сортируем по дате
-    result = list(latest_messages.values())
-    result.sort(key=lambda x: x.get("date", ""), reverse=True)  # Сортировка от новых к старым
+    # Сортировка от новых к старым
+    return sorted(latest_messages.values(), key=message_order, reverse=True)
 
-    return result
 
-async def fetch_emails_with_excel_attachments_async(imap, days=8):
-    """Async version of fetch_emails_with_excel_attachments"""
-    logger.info(f"Поиск писем с Excel-вложениями за последние %s дней...", days)
-    try:
+def message_order(message):
+    return message["timestamp"] or 0, int(message["email_id"])
+
+
+def quote_imap_string(value):
+    return '"' + value.replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+def search_email_criteria(days=8, last_uid=None, exclusions=True):
+    """
+    Критерии SEARCH: письма после last_uid, если он известен, иначе за
+    последние days дней; с exclusions — без накладных и исключённых отправителей.
+    """
+    if last_uid is None:
         last_day_date = (datetime.now() - timedelta(days=days)).strftime('%d-%b-%Y')
-        status, messages = await asyncio.to_thread(
-            imap.search, None, f'SINCE {last_day_date}'
-        )
-        if status != "OK":
-            logger.error("Ошибка поиска писем")
-            return []
+        criteria = [f'SINCE {last_day_date}']
+    else:
+        criteria = [f'UID {last_uid + 1}:*']
+    if exclusions:
+        criteria += [f"NOT SUBJECT {quote_imap_string(word)}" for word in EXCLUDED_SUBJECT_WORDS]
+        criteria += [f"NOT FROM {quote_imap_string(sender)}" for sender in EXCLUDED_SENDERS]
+    return " ".join(criteria)
 
-        email_ids = messages[0].split()
-        if not email_ids:
-            logger.debug("Писем за последние дни не обнаружено")
-            return []
 
-        fetch_command = ",".join(email_id.decode('utf-8') for email_id in email_ids)
-        res, fetched_data = await asyncio.to_thread(
-            imap.fetch, fetch_command, '(BODYSTRUCTURE BODY.PEEK[HEADER])'
+async def search_email_uids(pool, days=8, last_uid=None):
+    """
+    Ищет UID писем: после last_uid, если он известен, иначе за последние
+    days дней. Возвращает UID по возрастанию или None при ошибке.
+    """
+    if last_uid is None:
+        logger.info(f"Поиск писем с Excel-вложениями за последние %s дней...", days)
+    else:
+        logger.info("Поиск новых писем после UID %s...", last_uid)
+
+    try:
+        response = await pool.execute(
+            "uid_search", search_email_criteria(days, last_uid), metric="mail_search_seconds"
         )
+        if response.result != "OK":
+            # не всякий сервер ищет по UTF-8 в теме: фильтр тогда остаётся за filter_message
+            logger.warning("Сервер не принял исключения в поиске, ищем без них")
+            response = await pool.execute(
+                "uid_search", search_email_criteria(days, last_uid, exclusions=False),
+                metric="mail_search_seconds",
+            )
+    except CONNECTION_ERRORS as e:
+        logger.error(f"Ошибка поиска писем: {e}")
+        return None
+    if response.result != "OK":
+        logger.error("Ошибка поиска писем")
+        return None
 
-        messages_data = []
-        for response_part in fetched_data:
-            if isinstance(response_part, tuple):
-                try:
-                    bodystructure = response_part[0].decode()
-                    attachments = extract_excel_attachments_from_bodystructure(bodystructure)
-                    if not attachments:
-                        continue
-
-                    msg = email.message_from_bytes(response_part[1])
-                    msg_data = {
-                        "name": parseaddr(clean_header(msg["From"]))[0],
-                        "address": parseaddr(clean_header(msg["From"]))[1],
-                        "subject": clean_header(msg["Subject"]),
-                        "date": msg["Date"] or "Дата не указана",
-                        "email_id": response_part[0].split()[0].decode("utf-8"),
-                        "files": attachments
-                    }
-                    messages_data.append(msg_data)
-                except Exception as e:
-                    logger.error(f"Ошибка обработки письма: {e}")
+    # UID, а не номера сообщений: номера свои у каждого соединения пула.
+    # "n:*" всегда включает последнее письмо, даже если его UID меньше n.
+    uids = sorted(int(uid) for uid in response.lines[0].split() if uid.isdigit())
+    return [uid for uid in uids if last_uid is None or uid > last_uid]
 
-        return filter_message(messages_data)
-    except Exception as e:
-        logger.error(f"Ошибка в процессе извлечения писем: {e}")
-        return []
 
+def fetched_headers(fetched):
+    """
+    Заголовки из разобранного ответа FETCH: BODY[HEADER] или
+    BODY[HEADER.FIELDS (...)] — как бы сервер ни записал список полей.
+    """
+    for key, value in fetched.items():
+        if key.startswith("BODY[HEADER"):
+            return email.message_from_bytes(bytes(value))
+    raise KeyError("BODY[HEADER]")
 
-async def process_and_save_email(fetched_data, email_data, dir_path):
-    """Process email data and save attachments asynchronously."""
-    for response_part in fetched_data:
-        if not isinstance(response_part, tuple):
-            continue
 
+def parse_sender(msg):
+    return parseaddr(clean_header(msg["From"]))
+
+
+def parse_message_headers(lines):
+    """
+    Разбирает ответ FETCH (BODYSTRUCTURE и заголовки) и возвращает данные
+    писем с Excel-вложениями.
+    """
+    messages_data = []
+    for response_part in group_fetch_responses(lines):
         try:
-            msg = email.message_from_bytes(response_part[1])
-            for part in msg.walk():
-                content_disposition = part.get("Content-Disposition", "")
-                file_name = part.get_filename()
+            fetched = parse_fetch_response(response_part)
+            if "UID" not in fetched or "BODYSTRUCTURE" not in fetched:
+                continue  # непрошеный FETCH, например FLAGS
+            # секции вложений, чтобы потом скачать только их, а не письмо целиком
+            parts = extract_excel_attachments_from_bodystructure(fetched["BODYSTRUCTURE"])
+            if not parts:
+                continue
+
+            msg = fetched_headers(fetched)
+            name, address = parse_sender(msg)
+            try:
+                timestamp = parsedate_to_datetime(msg["Date"]).timestamp()
+            except (TypeError, ValueError):
+                timestamp = None
+            msg_data = {
+                "name": name,
+                "address": address,
+                "subject": clean_header(msg["Subject"]),
+                "date": msg["Date"] or "Дата не указана",
+                "timestamp": timestamp,
+                "email_id": fetched["UID"],
+                "files": list(dict.fromkeys(part.filename for part in parts)),
+                "parts": parts,
+            }
+            messages_data.append(msg_data)
+        except Exception as e:
+            logger.error(f"Ошибка обработки письма: {e}")
+    return messages_data
 
-                if not (file_name and "attachment" in content_disposition):
-                    continue
 
-                decoded_name = clean_header(file_name)
-                if decoded_name not in email_data["files"]:
-                    continue
+def format_uid_set(uids):
+    """Сворачивает UID в диапазоны: [1, 2, 3, 7] → "1:3,7"."""
+    ranges = []
+    for uid in sorted(uids):
+        if ranges and ranges[-1][1] == uid - 1:
+            ranges[-1][1] = uid
+        else:
+            ranges.append([uid, uid])
+    return ",".join(str(start) if start == end else f"{start}:{end}" for start, end in ranges)
 
-                file_extension = "." + decoded_name.split(".")[-1] if "." in decoded_name else ""
-                file_path = os.path.join(dir_path, email_data["address"] + file_extension)
 
-                payload = part.get_payload(decode=True)
-                await async_file_write(file_path, payload)
-                logger.debug(f"Сохранён файл: {file_path}")
+async def fetch_batch(pool, uids, items):
+    """Один UID FETCH пачки писем; возвращает строки ответа."""
+    response = await pool.execute(
+        "uid", "fetch", format_uid_set(uids), items, metric="mail_header_fetch_seconds"
+    )
+    pool.metrics.add("mail_header_fetch_bytes", sum(len(line) for line in response.lines))
+    if response.result != "OK":
+        raise aioimaplib.Error(f"Ошибка получения заголовков писем: {response.lines[-1:]}")
+    return response.lines
+
+
+async def fetch_message_headers(pool, uids):
+    """Запрашивает BODYSTRUCTURE и нужные заголовки одной пачки писем и сразу их разбирает."""
+    lines = await fetch_batch(
+        pool, uids, "(BODYSTRUCTURE BODY.PEEK[HEADER.FIELDS (FROM SUBJECT DATE)])"
+    )
+    return parse_message_headers(lines)
 
-        except Exception as e:
-            logger.error(f"Ошибка при сохранении вложения для письма {email_data['email_id']}: {e}")
 
+async def fetch_message_senders(pool, uids):
+    """Адреса отправителей пачки писем (в нижнем регистре) по UID — только заголовок From."""
+    lines = await fetch_batch(pool, uids, "(BODY.PEEK[HEADER.FIELDS (FROM)])")
+    senders = {}
+    for response_part in group_fetch_responses(lines):
+        fetched = parse_fetch_response(response_part)
+        # непрошеные FETCH (FLAGS и т.п.) приходят без UID или без заголовков
+        if "UID" not in fetched:
+            continue
+        try:
+            msg = fetched_headers(fetched)
+        except KeyError:
+            continue
+        senders[int(fetched["UID"])] = parse_sender(msg)[1].lower()
+    return senders
 
-async def async_file_write(file_path: str, data: bytes):
-    """Helper function to write files asynchronously."""
 
-    def _write():
-        with open(file_path, "wb") as f:
-            f.write(data)
+async def gather_batches(fetch, pool, uids, batch_size):
+    """Запускает fetch пачками по batch_size параллельно на соединениях пула."""
+    return await asyncio.gather(*(
+        fetch(pool, uids[start:start + batch_size])
+        for start in range(0, len(uids), batch_size)
+    ))
 
-    await asyncio.to_thread(_write)
 
+async def fetch_emails_with_excel_attachments_async(pool, uids, batch_size=BATCH_SIZE):
+    """
+    Находит последнее письмо с Excel-вложением от каждого отправителя и
+    возвращает его данные. None — при ошибке запроса.
+
+    Сначала у всех писем запрашивается только From. Затем BODYSTRUCTURE и
+    заголовки запрашиваются от новых UID к старым: в первом круге по одному
+    письму на отправителя, и только у отправителей, чьё письмо не подошло
+    (нет Excel, накладная), — следующие, каждый круг вдвое больше.
+    Письма запрашиваются пачками по batch_size параллельно на соединениях пула.
+    """
+    try:
+        if not uids:
+            logger.debug("Новых писем не обнаружено")
+            return []
 
-async def save_attachments_async(imap, emails):
-    """Async version of save_attachments"""
-    dir_path = "../" + os.getenv("SAVE_DIR")
+        senders = {}
+        for batch in await gather_batches(fetch_message_senders, pool, uids, batch_size):
+            senders.update(batch)
+        candidates = defaultdict(list)  # адрес → UID от новых к старым
+        for uid in sorted(senders, reverse=True):
+            candidates[senders[uid]].append(uid)
 
-    if not os.path.exists(dir_path):
-        await asyncio.to_thread(os.makedirs, dir_path)
+        messages_data = []
+        per_sender = 1
+        while candidates:
+            round_uids = sorted(uid for queue in candidates.values() for uid in queue[:per_sender])
+            batches = await gather_batches(fetch_message_headers, pool, round_uids, batch_size)
+            found = filter_message([msg_data for batch in batches for msg_data in batch])
+            messages_data += found
+
+            found_addresses = {msg_data["address"].lower() for msg_data in found}
+            candidates = {
+                address: queue[per_sender:]
+                for address, queue in candidates.items()
+                if address not in found_addresses and queue[per_sender:]
+            }
+            per_sender *= 2
+        return filter_message(messages_data)
+    except Exception as e:
+        logger.error(f"Ошибка в процессе извлечения писем: {e}")
+        return None
+
+
+def fetched_chunk(lines, email_id, key):
+    """
+    Кусок секции из ответа FETCH: значение key у письма email_id. aioimaplib
+    складывает в ответ команды и непрошеные FETCH (например, FLAGS других
+    писем), поэтому берётся только ответ с этим UID и этим ключом. Если его
+    нет, данные не получены — это ошибка, а не конец секции.
+    """
+    for response_part in group_fetch_responses(lines):
+        fetched = parse_fetch_response(response_part)
+        if key in fetched and fetched.get("UID") == str(email_id):
+            return fetched[key] or b""
+    raise aioimaplib.Error(f"В ответе FETCH нет {key} письма {email_id}")
+
+
+async def download_part(pool, email_id, part, file_path, sender=None):
+    """
+    Скачивает секцию письма кусками по FETCH_CHUNK_SIZE (BODY.PEEK[n]<offset.size>)
+    и декодирует их на лету в новый файл file_path. В памяти одновременно не
+    больше одного куска. Возвращает sha256 декодированного содержимого;
+    при ошибке недокачанный файл удаляется. Время и объёмы сети и диска
+    записываются в pool.metrics с меткой sender.
+    """
+    metrics = pool.metrics
+    decoder = TransferDecoder(part.encoding)
+    digest = hashlib.sha256()
+    try:
+        async with aiofiles.open(file_path, mode="xb") as f:
+            offset = 0
+            while True:
+                response = await pool.execute(
+                    "uid", "fetch", email_id,
+                    f"(BODY.PEEK[{part.section}]<{offset}.{FETCH_CHUNK_SIZE}>)",
+                    metric="mail_fetch_seconds", sender=sender,
+                )
+                if response.result != "OK":
+                    raise aioimaplib.Error(f"Ошибка получения секции {part.section}: {response.lines[-1:]}")
+
+                chunk = fetched_chunk(response.lines, email_id, f"BODY[{part.section}]<{offset}>")
+                data = decoder.feed(bytes(chunk))
+                digest.update(data)
+                with metrics.timer("mail_disk_seconds", sender=sender):
+                    await f.write(data)
+                metrics.add("mail_fetch_bytes", len(chunk), sender=sender)
+                metrics.add("mail_attachment_bytes", len(data), sender=sender)
+                offset += len(chunk)
+
+                if len(chunk) < FETCH_CHUNK_SIZE or (part.size is not None and offset >= part.size):
+                    break
+            if part.size is not None and offset != part.size:
+                raise aioimaplib.Error(
+                    f"Секция {part.section} письма {email_id}: получено {offset} байт из {part.size}"
+                )
+            data = decoder.flush()
+            digest.update(data)
+            with metrics.timer("mail_disk_seconds", sender=sender):
+                await f.write(data)
+            metrics.add("mail_attachment_bytes", len(data), sender=sender)
+    except BaseException:
+        if os.path.exists(file_path):
+            os.unlink(file_path)
+        raise
+    return digest.hexdigest()
+
+
+def partial_path(file_path):
+    """Временное имя для записи рядом с file_path: скрытое и с PARTIAL_SUFFIX."""
+    return os.path.join(
+        os.path.dirname(file_path),
+        f".{os.path.basename(file_path)}.{os.urandom(4).hex()}{PARTIAL_SUFFIX}"
+    )
+
+
+async def download_blob(pool, email_id, part, dir_path, file_extension, sender=None):
+    """
+    Скачивает вложение в кэш SAVE_DIR/.blobs под именем sha256 содержимого
+    и возвращает (путь к файлу кэша, sha256). Уже лежащий в кэше файл с тем
+    же хэшем не перезаписывается, если только его размер не разошёлся.
+    """
+    blob_dir = os.path.join(dir_path, BLOB_DIR)
+    tmp_path = partial_path(os.path.join(blob_dir, "blob"))
+    sha256 = await download_part(pool, email_id, part, tmp_path, sender)
+    blob_path = os.path.join(blob_dir, sha256 + file_extension)
+    if os.path.isfile(blob_path) and os.path.getsize(blob_path) == os.path.getsize(tmp_path):
+        os.unlink(tmp_path)
+    else:
+        os.replace(tmp_path, blob_path)
+    return blob_path, sha256
+
+
+def link_price_file(blob_path, file_path):
+    """
+    Атомарно заменяет прайс поставщика жёсткой ссылкой на файл кэша, а если
+    файловая система их не умеет — копией. Прайсы дальше только читаются
+    и переименовываются, поэтому общая с кэшем запись им не мешает.
+    """
+    tmp_path = partial_path(file_path)
+    try:
+        os.link(blob_path, tmp_path)
+    except OSError:
+        shutil.copyfile(blob_path, tmp_path)
+    try:
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def is_manifest_entry_intact(dir_path, entry):
+    """Прайс из записи манифеста на месте и не менялся после сохранения."""
+    try:
+        stat = os.stat(os.path.join(dir_path, entry["file"]))
+    except (KeyError, OSError):
+        return False
+    return (stat.st_size, stat.st_mtime_ns) == (entry.get("size"), entry.get("mtime_ns"))
+
+
+async def save_email_attachments(pool, email_data, dir_path, manifest, on_saved=None):
+    """
+    Скачивает по UID только секции Excel-вложений письма в кэш и ставит их
+    прайсом поставщика, обновляя его запись в манифесте. Вложение, уже
+    сохранённое из этого же письма, не запрашивается повторно, а прайс с
+    прежним содержимым не перезаписывается. False — при ошибке.
+    """
+    email_id = email_data["email_id"]
+    address = email_data["address"].lower()
+    mail_timestamp = email_data["timestamp"] or time.time()
+
+    for part in email_data["parts"]:
+        file_extension = "." + part.filename.split(".")[-1].lower() if "." in part.filename else ""
+        file_name = address + file_extension
+        file_path = os.path.join(dir_path, file_name)
+        source = f"{pool.uidvalidity}:{email_id}:{part.section}"
+        entry = manifest.get(address, {})
+        intact = entry.get("file") == file_name and is_manifest_entry_intact(dir_path, entry)
+        if intact and entry.get("source") == source:
+            logger.debug("Вложение %s уже сохранено", file_name)
+            continue
 
-    for file in os.listdir(dir_path):
-        file_path = os.path.join(dir_path, file)
         try:
-            if os.path.isfile(file_path):
-                await asyncio.to_thread(os.unlink, file_path)
+            blob_path, sha256 = await download_blob(
+                pool, email_id, part, dir_path, file_extension, address
+            )
+        except CONNECTION_ERRORS as e:
+            logger.error("Не удалось скачать письмо %s после %s попыток: %s", email_id, RETRY_ATTEMPTS, e)
+            return False
         except Exception as e:
-            logger.error("Ошибка удаления файла %s:", file_path, e)
+            logger.error(f"Ошибка при сохранении вложения для письма {email_id}: {e}")
+            return False
 
-    for email_data in emails:
-        email_id = email_data["email_id"]
-        res, fetched_data = await asyncio.to_thread(
-            imap.fetch, email_id, '(BODY.PEEK[])'
-        )
-        if res != "OK":
-            logger.error("Ошибка получения тела письма для ID %s", email_id)
-            continue
+        if intact and entry.get("sha256") == sha256:
+            logger.debug("Прайс %s не изменился", file_name)
+        else:
+            with pool.metrics.timer("mail_disk_seconds", sender=address):
+                await asyncio.to_thread(link_price_file, blob_path, file_path)
+            remove_other_price_files(dir_path, address, keep=file_path)
+            logger.debug(f"Сохранён файл: {file_path}")
+            if on_saved is not None:
+                on_saved(file_path, sha256)
+
+        stat = os.stat(file_path)
+        manifest[address] = {
+            "file": file_name,
+            "sha256": sha256,
+            "source": source,
+            "date": mail_timestamp,
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+        }
+    return True
+
+
+def remove_other_price_files(dir_path, address, keep):
+    """Удаляет прайс поставщика с другим расширением, чтобы не остался старый."""
+    for file_extension in PRICE_FILE_EXTENSIONS:
+        file_path = os.path.join(dir_path, address + file_extension)
+        if file_path != keep and os.path.isfile(file_path):
+            os.unlink(file_path)
+
+
+def remove_stale_price_files(dir_path, manifest, days, seen=None):
+    """
+    Убирает из каталога и манифеста прайсы из писем старше days дней, а при
+    полном просмотре (seen — адреса найденных отправителей) и прайсы
+    поставщиков, чьих писем не нашлось. Заодно удаляет прайсы, которых нет
+    в манифесте, и файлы кэша, на которые манифест больше не ссылается.
+    """
+    since = (datetime.now() - timedelta(days=days)).date()
+    cutoff = datetime(since.year, since.month, since.day).timestamp()
+    for address, entry in list(manifest.items()):
+        if entry["date"] < cutoff or (seen is not None and address not in seen):
+            logger.info("Удалён устаревший прайс %s", entry["file"])
+            del manifest[address]
+
+    files = {entry["file"] for entry in manifest.values()}
+    for file in os.listdir(dir_path):
+        if file.lower().endswith(PRICE_FILE_EXTENSIONS) and file not in files:
+            os.unlink(os.path.join(dir_path, file))
 
-        await process_and_save_email(fetched_data, email_data, dir_path)
+    blob_dir = os.path.join(dir_path, BLOB_DIR)
+    if os.path.isdir(blob_dir):
+        blobs = {entry["sha256"] + os.path.splitext(entry["file"])[1] for entry in manifest.values()}
+        for blob in os.listdir(blob_dir):
+            if blob not in blobs:
+                os.unlink(os.path.join(blob_dir, blob))
 
 
+async def save_attachments_async(pool, emails, dir_path, manifest, on_saved=None):
+    """
+    Сохраняет вложения писем через кэш SAVE_DIR/.blobs и обновляет manifest.
+    Письма скачиваются параллельно, не больше pool.pool_size одновременно.
+    Прайсы отправителей без новых писем остаются на месте. Возвращает True,
+    если всё сохранено.
+    """
+    blob_dir = os.path.join(dir_path, BLOB_DIR)
+    await asyncio.to_thread(os.makedirs, blob_dir, exist_ok=True)
+
+    # недокачанные файлы прошлых запусков
+    for directory in (dir_path, blob_dir):
+        for file in os.listdir(directory):
+            if not file.endswith(PARTIAL_SUFFIX):
+                continue
+            file_path = os.path.join(directory, file)
+            try:
+                await asyncio.to_thread(os.unlink, file_path)
+            except Exception as e:
+                logger.error("Ошибка удаления файла %s: %s", file_path, e)
 
+    results = await asyncio.gather(
+        *(save_email_attachments(pool, email_data, dir_path, manifest, on_saved) for email_data in emails)
+    )
+    return all(results)
 
 
-def main_mail() -> bool:
+def main_mail(on_saved=None) -> bool:
     logger.info("Запуск почтовой службы")
     try:
-        asyncio.run(start_server_email_standalone())
+        asyncio.run(start_server_email_standalone(on_saved=on_saved))
         # asyncio.run(print_grouped_sender_addresses())
         return True
     except Exception as e:
@@ -0,0 +1,125 @@
+import logging
+import os
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Метрики последнего обхода почты в текстовом формате Prometheus; лежит рядом
+# с сохранёнными прайсами, отдаётся представлением mail_metrics
+MAIL_METRICS_FILE = ".mail_metrics.prom"
+
+METRIC_HELP = {
+    "mail_run_seconds": "Длительность обхода почты",
+    "mail_connect_seconds": "Подключение к IMAP-серверу до приветствия",
+    "mail_login_seconds": "LOGIN и SELECT ящика",
+    "mail_search_seconds": "Длительность SEARCH",
+    "mail_header_fetch_seconds": "FETCH отправителей, BODYSTRUCTURE и заголовков",
+    "mail_header_fetch_bytes": "Объём ответов FETCH заголовков",
+    "mail_fetch_seconds": "FETCH вложений письма",
+    "mail_fetch_bytes": "Объём вложений письма на проводе (до декодирования)",
+    "mail_attachment_bytes": "Размер вложений после декодирования",
+    "mail_disk_seconds": "Запись вложений на диск и установка прайса",
+}
+
+
+class MailMetrics:
+    """
+    Замеры одного обхода почты: длительности в секундах и объёмы в байтах с
+    метками (например, sender). Одинаковые имя и метки суммируются.
+    """
+
+    def __init__(self):
+        self.values = defaultdict(float)
+        self.started = time.perf_counter()
+
+    def add(self, name, value, **labels):
+        self.values[name, tuple(sorted(labels.items()))] += value
+
+    @contextmanager
+    def timer(self, name, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - started, **labels)
+
+    def by_sender(self):
+        """{отправитель: {метрика: значение}} — по убыванию времени скачивания."""
+        senders = defaultdict(dict)
+        for (name, labels), value in self.values.items():
+            sender = dict(labels).get("sender")
+            if sender is not None:
+                senders[sender][name] = senders[sender].get(name, 0) + value
+        return dict(
+            sorted(
+                senders.items(),
+                key=lambda item: item[1].get("mail_fetch_seconds", 0),
+                reverse=True,
+            )
+        )
+
+    def to_prometheus(self):
+        """Текстовый формат Prometheus (exposition format 0.0.4)."""
+        samples = defaultdict(list)
+        for (name, labels), value in sorted(self.values.items()):
+            samples[name].append((labels, value))
+
+        lines = []
+        for name, values in samples.items():
+            if name in METRIC_HELP:
+                lines.append(f"# HELP {name} {METRIC_HELP[name]}")
+            lines.append(f"# TYPE {name} gauge")
+            for labels, value in values:
+                label_text = ",".join(
+                    f'{key}="{_escape_label(str(label))}"' for key, label in labels
+                )
+                lines.append(
+                    f"{name}{{{label_text}}} {value:g}"
+                    if labels
+                    else f"{name} {value:g}"
+                )
+        return "\n".join(lines) + "\n"
+
+
+def _escape_label(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def report_mail_metrics(metrics, dir_path):
+    """
+    Хук метрик по окончании обхода: запись лога с полем mail_metrics (все
+    значения и разбивка по отправителям) и файл MAIL_METRICS_FILE для Prometheus.
+    """
+    metrics.add("mail_run_seconds", time.perf_counter() - metrics.started)
+    senders = metrics.by_sender()
+    fields = {
+        "totals": {
+            name: value
+            for (name, labels), value in metrics.values.items()
+            if not labels
+        },
+        "senders": senders,
+    }
+    slowest = next(iter(senders.items()), None)
+    logger.info(
+        "Метрики почты: обход %.2f с, скачаны вложения %s отправителей%s",
+        fields["totals"]["mail_run_seconds"],
+        len(senders),
+        (
+            f", дольше всех {slowest[0]} ({slowest[1].get('mail_fetch_seconds', 0):.2f} с)"
+            if slowest
+            else ""
+        ),
+        extra={"mail_metrics": fields},
+    )
+
+    file_path = os.path.join(dir_path, MAIL_METRICS_FILE)
+    try:
+        os.makedirs(dir_path, exist_ok=True)
+        with open(file_path + ".tmp", "w", encoding="utf-8") as f:
+            f.write(metrics.to_prometheus())
+        os.replace(file_path + ".tmp", file_path)
+    except OSError as e:
+        logger.warning("Не удалось записать метрики почты в %s: %s", file_path, e)
@@ -15,7 +15,6 @@ from .french_normalizer import FrenchNameNormalizer
 from .constants import (
     CONCENTRATION_MAP,
     TYPE_KEYWORDS,
-    EXTRA_INFO_WORDS,
     GENDER_PATTERNS,
     COMMON_VOLUMES,
     FLANKER_SYNONYMS,
@@ -25,6 +24,7 @@ from .constants import (
 # from dotenv import load_dotenv
 
 from .brand import get_standard_brand_fuzzy, get_brand_from_name
+from .keywords import EXTRA_INFO_RE
 from ..utils.price_file_formatter import format_price_list
 
 
@@ -287,13 +287,6 @@ def extract_gender(text: str) -> str:
     return ""
 
 
-# ─── стало ────────────────────────────────────────────────────────
-_extra_re = re.compile(
-    r"\b(?:" + "|".join(map(re.escape, EXTRA_INFO_WORDS)) + r")\b",
-    flags=re.IGNORECASE,
-)
-
-
 def clean_extra_info(text: str) -> str:
     """
     Убирает кавычки, [скобки] и «мусорные» слова из EXTRA_INFO_WORDS
@@ -305,7 +298,7 @@ def clean_extra_info(text: str) -> str:
     text = re.sub(r"№\s+(\d+)", r"№\1", text)
 
     # новый быстрый вызов
-    text = _extra_re.sub("", text)
+    text = EXTRA_INFO_RE.sub("", text)
 
     return re.sub(r"\s+", " ", text).strip()
 
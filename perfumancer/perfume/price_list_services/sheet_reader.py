@@ -0,0 +1,107 @@
+import logging
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from openpyxl import load_workbook
+from openpyxl.cell.cell import TYPE_ERROR, TYPE_NUMERIC
+from pandas.io.parsers import TextParser
+
+try:
+    import python_calamine  # noqa: F401
+
+    CALAMINE_AVAILABLE = True
+except ImportError:
+    CALAMINE_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+
+class SheetReadError(ValueError):
+    """
+    Файл не читается как книга Excel: битый или в неподдерживаемом формате.
+    Наследует ValueError, поэтому разбор пропускает такой файл.
+    """
+
+
+def _convert_cell(cell):
+    """Приводит значение ячейки так же, как это делает pandas для openpyxl."""
+    if cell.value is None:
+        return ""
+    elif cell.data_type == TYPE_ERROR:
+        return np.nan
+    elif cell.data_type == TYPE_NUMERIC:
+        value = int(cell.value)
+        if value == cell.value:
+            return value
+        return float(cell.value)
+    return cell.value
+
+
+def _iter_xlsx_rows(file_path: Path, nrows: int | None, max_col: int | None):
+    """
+    Построчно читает первый лист в режиме read_only. Ячейки правее max_col
+    не конвертируются и не попадают в результат.
+    """
+    workbook = load_workbook(file_path, read_only=True, data_only=True, keep_links=False)
+    try:
+        sheet = workbook.worksheets[0]
+        sheet.reset_dimensions()
+        for row_number, row in enumerate(sheet.iter_rows(max_col=max_col)):
+            if nrows is not None and row_number >= nrows:
+                break
+            yield [_convert_cell(cell) for cell in row]
+    finally:
+        workbook.close()
+
+
+def _rows_to_frame(rows) -> pd.DataFrame:
+    """Собирает DataFrame из строк по тем же правилам, что и pd.read_excel."""
+    data = []
+    last_row_with_data = -1
+    for row_number, row in enumerate(rows):
+        while row and row[-1] == "":
+            row.pop()
+        if row:
+            last_row_with_data = row_number
+        data.append(row)
+
+    data = data[: last_row_with_data + 1]
+    if not data:
+        return pd.DataFrame()
+
+    max_width = max(len(row) for row in data)
+    data = [row + [""] * (max_width - len(row)) for row in data]
+    return TextParser(data, header=None, skip_blank_lines=False).read()
+
+
+def read_sheet(
+    file_path, nrows: int | None = None, max_col: int | None = None
+) -> pd.DataFrame:
+    """
+    Читает первый лист Excel-файла (.xlsx или .xls) без заголовка.
+
+    :param nrows: прочитать не больше nrows строк
+    :param max_col: не читать колонки правее max_col (нумерация с 1)
+    """
+    file_path = Path(file_path)
+
+    try:
+        if not is_streamed(file_path):
+            # calamine и xlrd читают лист целиком; старые .xls разбираем
+            # напрямую, без промежуточной конвертации в .xlsx. Без calamine
+            # движок pandas выбирает по содержимому: поставщики присылают и
+            # .xlsx, сохранённые с расширением .xls
+            engine = "calamine" if CALAMINE_AVAILABLE else None
+            df = pd.read_excel(file_path, engine=engine, header=None, nrows=nrows)
+            return df.iloc[:, :max_col] if max_col else df
+
+        return _rows_to_frame(_iter_xlsx_rows(file_path, nrows, max_col))
+    except Exception as error:
+        # xlrd, openpyxl и zipfile бросают каждый свои исключения
+        raise SheetReadError(f"не удалось прочитать книгу Excel: {error}") from error
+
+
+def is_streamed(file_path) -> bool:
+    """True, если файл читается построчно и имеет смысл читать его частями."""
+    return not CALAMINE_AVAILABLE and Path(file_path).suffix.lower() == ".xlsx"
@@ -1,11 +1,20 @@
+import hashlib
 import logging
 import os
 import re
+from collections import Counter
+from concurrent.futures import Executor, Future
+from decimal import Decimal
+from functools import partial
+from itertools import repeat
 from typing import List
 
+import billiard
+import django
 import pandas as pd
 import numpy as np
 from pathlib import Path
+from django.db import connections, transaction
 from dotenv import load_dotenv
 from openpyxl import load_workbook
 
@@ -13,32 +22,66 @@ from openpyxl import load_workbook
 
 from ..utils.custom_logging import configure_color_logging
 
-from ..models import Brand, Product, PriceList, Supplier, ProductBase, CurrencyRate
-
-from .brand import get_standard_brand_fuzzy, get_brand_aliases, get_brand_from_name
+from ..models import (
+    Brand,
+    Product,
+    PriceList,
+    PriceFile,
+    PriceGeneration,
+    Supplier,
+    ProductBase,
+    CurrencyRate,
+)
+
+from .brand import (
+    brand_resolver,
+    brand_synonyms,
+    brands_from_names,
+    get_brand_alias_pattern,
+    get_brand_aliases,
+    resolve_brands,
+    unique_brands,
+)
+from .sheet_reader import is_streamed, read_sheet
 from .xls_formatter import format_xls_to_xlsx
+from .mail import get_price_file_hashes
 from .mail import main_mail as renew_prices_from_mail
 from .normalizer import main as normalize_brands_names
 from .price_data_cleaner import main as clear_price_data
 
-from .constants import GARBAGE_WORDS, EXTRA_INFO_WORDS
+from .keywords import EXTRA_INFO_RE, GARBAGE_RE
 
 logger = logging.getLogger(__name__)
 configure_color_logging(level="INFO")
 load_dotenv()
 
+# Количество процессов для разбора прайс-листов; 1 — последовательный режим
+PARSER_WORKERS = int(os.getenv("PRICE_PARSER_WORKERS", "1"))
+# Сколько строк читаем, чтобы заранее найти колонку с ценой
+SAMPLE_ROWS = 200
+# Версия разбора в контексте сохранённых результатов (PriceFile). Увеличивать
+# при любом изменении разбора, иначе неизменившиеся файлы останутся со старым
+PARSER_VERSION = 1
+
 
 def get_currency_rate(currency_code):
-    try:
-        rate = CurrencyRate.objects.get(currency=currency_code).rate
-        print(f"USDRUB: {rate}")
-        return float(rate)
-    except CurrencyRate.DoesNotExist:
+    """
+    Курс валюты из базы, мимо кэша веб-запросов. Читается один раз на
+    обновление прайсов и передаётся дальше, чтобы весь разбор шёл по одному курсу.
+    """
+    rate = (
+        CurrencyRate.objects.filter(currency=currency_code)
+        .values_list("rate", flat=True)
+        .first()
+    )
+    if rate is None:
         logger.warning(
             "Курс валюты для %s не найден в базе данных, возвращаем курс по умолчанию",
             currency_code,
         )
         return float(120)
+    logger.info("Курс %s: %s", currency_code, rate)
+    return float(rate)
 
 
 def clean_name(name, brand):
@@ -69,12 +112,73 @@ def clean_name(name, brand):
     return name.lstrip(":").strip()
 
 
-def auto_detect_columns(df):
+def clean_names(names: pd.Series, brands: pd.Series) -> pd.Series:
+    """
+    Колоночный вариант clean_name: результат тот же, но без Python-кода на
+    каждую строку. Нормализация и отрезание бренда в начале названия — методами
+    .str по всей колонке; алиасы ищутся одной регуляркой из скомпилированных
+    альтернатив брендов (get_brand_alias_pattern), а заменяются только в
+    найденных строках, группами по бренду.
+    """
+    names = (
+        names.str.lower()
+        .str.replace("`", "'", regex=False)
+        .str.replace("''", "'", regex=False)
+        .str.replace("'nina'", "nina", regex=False)
+        .str.strip()
+        .str.rstrip(".")
+        .str.replace(r"\s+", " ", regex=True)
+    )
+
+    has_brand = brands.notna() & brands.astype(bool)
+    if not has_brand.any():
+        return names.str.lstrip(":").str.strip()
+
+    brand_lower = brands[has_brand].str.lower()
+    # "бренд\x1fназвание": регулярки ниже сопоставляют название со своим брендом
+    keyed = brand_lower + "\x1f" + names[has_brand]
+
+    patterns = {
+        brand: pattern
+        for brand in brand_lower.unique()
+        if (pattern := get_brand_alias_pattern(brand)) is not None
+    }
+    if patterns:
+        any_alias = re.compile(
+            "|".join(
+                f"{re.escape(brand)}\x1f.*?(?:{pattern.pattern})"
+                for brand, pattern in patterns.items()
+            ),
+            re.DOTALL,
+        )
+        has_alias = keyed.str.match(any_alias)
+        renamed = []
+        for brand, group in names[has_brand][has_alias].groupby(
+            brand_lower[has_alias], sort=False
+        ):
+            for alias in get_brand_aliases(brand):
+                group = group.str.replace(alias, "", regex=False)
+            renamed.append(brand + "\x1f" + brand + " " + group)
+        if renamed:
+            keyed.update(pd.concat(renamed))
+
+    # Бренд в начале названия отрезается вместе со следующим символом
+    names[has_brand] = keyed.str.replace(
+        r"^([^\x1f]*)\x1f(?:\1.?)?", "", regex=True, flags=re.DOTALL
+    )
+    return names.str.lstrip(":").str.strip()
+
+
+def auto_detect_columns(df, usd_rate=None):
     """
     Автоматически определяет, какие колонки соответствуют 'Название' и 'Цена'.
+
+    :param usd_rate: курс USD; если не передан, берётся из базы данных
     """
     name_col = None
     price_col = None
+    if usd_rate is None:
+        usd_rate = get_currency_rate("USD")
 
     # Убираем строки без данных в начале
     df = df.dropna(how="all").reset_index(drop=True)
@@ -119,9 +223,7 @@ def auto_detect_columns(df):
 
         # Проверяем, что хотя бы 50% значений заполнены, числовые и не равны нулю и меньше 5000
         numeric_values = pd.to_numeric(non_empty_values, errors="coerce")
-        count_above_5000 = (
-            numeric_values.astype(float) > (5000 * get_currency_rate("USD"))
-        ).sum()
+        count_above_5000 = (numeric_values.astype(float) > (5000 * usd_rate)).sum()
 
         if (
             numeric_values.notna().mean() > 0.5
@@ -154,8 +256,7 @@ def auto_detect_columns(df):
 def clean_extra_info(text: str) -> str:
     text = re.sub(r"\[.*?\]", "", text)  # убираем [ ... ]
     text = re.sub(r"[\"“”\']+", "", text)  # кавычки
-    for w in EXTRA_INFO_WORDS:
-        text = re.sub(rf"\b{w}\b", "", text)
+    text = EXTRA_INFO_RE.sub("", text)
     return re.sub(r"\s+", " ", text).strip()
 
 
@@ -172,6 +273,12 @@ def fill_nan_brands_from_context(
       1) Последнего ненулевого бренда в window_up строках выше (orig_brand).
       2) Либо если в следующих window_down названиях встречается этот бренд.
       3) Либо если предыдущая строка (уже после заливки) была тем же брендом — даем каскадную заливку.
+
+    Правило 3 поглощает правило 2: первая пустая строка серии стоит сразу под
+    строкой с брендом, поэтому заливается всегда, а за ней каскадом и вся
+    серия, пока бренд сверху не дальше window_up строк. Поэтому достаточно
+    протянуть последний бренд вниз не больше чем на window_up строк;
+    window_down на результат не влияет и оставлен для совместимости.
     """
     # валидация
     if name_col not in df.columns:
@@ -180,42 +287,27 @@ def fill_nan_brands_from_context(
         raise ValueError("Column 'brand' not found")
 
     df_work = df.copy()
-    n = len(df_work)
 
     # сохраним исходный бренд, чтобы искать только по нему «заголовки»
-    orig_brand = df_work["brand"].copy()
+    orig_brand = df_work["brand"]
 
     # найдём все позиции, где марки «пустые»
-    is_missing = orig_brand.isna() | orig_brand.isin(missing_values)
-    nan_positions = [i for i, m in enumerate(is_missing) if m]
-
-    brand_col_idx = df_work.columns.get_loc("brand")
-    filled = 0
-
-    for pos in nan_positions:
-        # 1) последний ненулевой бренд вверху
-        start = max(0, pos - window_up)
-        above = orig_brand.iloc[start:pos]
-        valid = above[~above.isna() & ~above.isin(missing_values)]
-        if valid.empty:
-            continue
-        closest = valid.iloc[-1]
-
-        # 2) проверяем вхождение в тексты ниже
-        end = min(n, pos + window_down + 1)
-        below_names = df_work.iloc[pos + 1 : end][name_col].dropna().astype(str)
-        contains = below_names.str.contains(
-            re.escape(str(closest)), case=False, na=False
-        ).any()
-
-        # 3) Каскадная заливка: если сразу под уже залитой строкой
-        prev_same = pos > 0 and df_work.iat[pos - 1, brand_col_idx] == closest
-
-        if contains or prev_same:
-            df_work.iat[pos, brand_col_idx] = closest
-            filled += 1
-
-    msg = f"fill_nan_brands_from_context: заполнено {filled} из {len(nan_positions)} пропусков"
+    is_missing = (orig_brand.isna() | orig_brand.isin(missing_values)).to_numpy()
+
+    # для каждой строки — позиция последнего ненулевого бренда не ниже неё
+    positions = np.arange(len(df_work))
+    last_valid = np.maximum.accumulate(np.where(is_missing, -1, positions))
+    to_fill = is_missing & (last_valid >= 0) & (positions - last_valid <= window_up)
+    fill_positions = np.flatnonzero(to_fill)
+
+    if len(fill_positions):
+        brand_col_idx = df_work.columns.get_loc("brand")
+        df_work.iloc[fill_positions, brand_col_idx] = orig_brand.iloc[
+            last_valid[fill_positions]
+        ].to_numpy()
+    filled = len(fill_positions)
+
+    msg = f"fill_nan_brands_from_context: заполнено {filled} из {is_missing.sum()} пропусков"
     if logger:
         logger.info(msg)
     else:
@@ -224,10 +316,49 @@ def fill_nan_brands_from_context(
     return df_work
 
 
-def process_price_list(file_path):
-    """Обрабатывает один прайс-лист, выделяет торговые марки и сопоставляет их с товарами."""
+def _price_col_bound(df, usd_rate):
+    """Номер (с 1) колонки с ценой или None, если колонки не определяются."""
+    df = df.set_axis([f"Колонка {i}" for i in range(len(df.columns))], axis=1)
+    try:
+        _, price_col = auto_detect_columns(df, usd_rate)
+    except (ValueError, TypeError, AttributeError):
+        return None
+    if price_col is None:
+        return None
+    return df.columns.get_loc(price_col) + 1
+
+
+def read_price_sheet(file_path, usd_rate=None):
+    """
+    Читает прайс-лист. Колонки с названием и ценой определяются по первым
+    SAMPLE_ROWS строкам, после чего файл дочитывается только до колонки с ценой.
+    Если по обрезанной таблице колонки не определяются, файл читается целиком.
+    """
+    if not is_streamed(file_path):
+        return read_sheet(file_path)
+
+    max_col = _price_col_bound(read_sheet(file_path, nrows=SAMPLE_ROWS), usd_rate)
+    if max_col is None:
+        return read_sheet(file_path)
+
+    df = read_sheet(file_path, max_col=max_col)
+    if _price_col_bound(df, usd_rate) is None:
+        logger.debug("Колонки не определились по обрезанной таблице: %s", file_path)
+        return read_sheet(file_path)
+    return df
+
+
+def process_price_list(file_path, usd_rate=None):
+    """
+    Обрабатывает один прайс-лист, выделяет торговые марки и сопоставляет их с товарами.
+
+    Если передан usd_rate, функция не обращается к базе данных и может
+    выполняться в отдельном процессе.
+    """
     logger.info("Чтение файла: %s", file_path)
-    df = pd.read_excel(file_path, engine="openpyxl", header=None)
+    if usd_rate is None:
+        usd_rate = get_currency_rate("USD")
+    df = read_price_sheet(file_path, usd_rate)
     if len(df) < 30:
         logger.warning(
             f"⚠️ Пропущен файл {file_path.name} из-за малого количества строк."
@@ -238,7 +369,7 @@ def process_price_list(file_path):
 
     # Определяем основные колонки
     try:
-        name_col, price_col = auto_detect_columns(df)
+        name_col, price_col = auto_detect_columns(df, usd_rate)
     except ValueError as e:
         logger.warning(f"⚠️ Ошибка при автоматическом определении колонок: {e}")
         return None  # Прекращаем обработку текущего файла
@@ -257,69 +388,28 @@ def process_price_list(file_path):
     df = df.dropna(subset=[name_col]).reset_index(drop=True)
 
     # Чистим мусор
-    garbage_pattern = re.compile(
-        r"\b(?:" + "|".join(map(re.escape, GARBAGE_WORDS)) + r")\b", flags=re.IGNORECASE
-    )
-    mask = df[name_col].astype(str).str.contains(garbage_pattern, na=False, regex=True)
+    mask = df[name_col].astype(str).str.contains(GARBAGE_RE, na=False, regex=True)
     df = df[~mask]  # копируем DataFrame ровно один раз
 
     # Чистим ячейки от «лишней» информации
-    extra_pattern = re.compile(
-        r"\b(?:" + "|".join(map(re.escape, EXTRA_INFO_WORDS)) + r")\b",
-        flags=re.IGNORECASE,
-    )
-
     df[name_col] = (
         df[name_col]
         .astype(str)
-        .str.replace(extra_pattern, "", regex=True)  # одно векторное применение
+        .str.replace(EXTRA_INFO_RE, "", regex=True)  # одно векторное применение
         .str.replace(r"\s{2,}", " ", regex=True)  # убираем двойные пробелы
         .str.strip()
     )
 
-    # Обработка брендов
-    df["brand"] = None
-    # current_brand = None
-
-    # df["brand"] = df["brand"].replace(
-    #     to_replace=r"^\s*(NAN|nan|NaN)\s*$", value=pd.NA, regex=True
-    # )
-
-    brands = []
-    for i, row in df.iterrows():
-        name = row[name_col]
-        price = row[price_col]
-
-        # Определяем, является ли строка брендом
-        if pd.isna(price) and name.strip():
-            current_brand = name.strip().replace("\xa0", " ")
-            current_brand = get_standard_brand_fuzzy(current_brand)
-        else:
-            current_brand = None
-
-        brands.append(current_brand)
-
-    if len(brands) != len(df):
-        logger.warning(
-            f"Длина brands ({len(brands)}) не совпадает с длиной df ({len(df)}), корректируем."
-        )
-        brands = (
-            brands[: len(df)]
-            if len(brands) > len(df)
-            else brands + [None] * (len(df) - len(brands))
-        )
-
-    df["brand"] = brands
+    # Строки без цены — заголовки брендов. Уникальные заголовки сопоставляются
+    # одним пакетом и раздаются обратно по индексу; у остальных строк бренда нет
+    header_mask = df[price_col].isna() & (df[name_col].str.strip() != "")
+    header_names = df.loc[header_mask, name_col].str.strip().str.replace("\xa0", " ")
+    standard_brands = resolve_brands(header_names.unique())
+    df["brand"] = header_names.map(standard_brands).reindex(df.index).astype(object)
 
     # Получаем бренд из имени
-    df["brand"] = df.apply(
-        lambda x: (
-            get_brand_from_name(x[name_col])
-            if pd.isna(x["brand"]) or x["brand"] == "NAN"
-            else x["brand"]
-        ),
-        axis=1,
-    )
+    missing_brand = df["brand"].isna() | (df["brand"] == "NAN")
+    df.loc[missing_brand, "brand"] = brands_from_names(df.loc[missing_brand, name_col])
 
     # смотрим на строки с брендом NAN,
     # если выше чем на 10 строк есть строка с брендом и
@@ -341,13 +431,13 @@ def process_price_list(file_path):
         )
 
         # получаем курс валюты из БД c приведением к Decimal
-        usd_rub = pd.to_numeric(get_currency_rate("USD"), errors="coerce")
+        usd_rub = pd.to_numeric(usd_rate, errors="coerce")
 
         # приводим цены к доллару
         df[price_col] = df[price_col] / usd_rub
 
     result_columns = ["brand", name_col, price_col]
-    df[name_col] = df.apply(lambda x: clean_name(x[name_col], x["brand"]), axis=1)
+    df[name_col] = clean_names(df[name_col], df["brand"])
 
     final_df = df[result_columns].rename(columns={name_col: "name", price_col: "price"})
 
@@ -357,12 +447,35 @@ def process_price_list(file_path):
     return final_df
 
 
-def save_price_lists(df, filename):
+# Максимум id в одном запросе (ограничение SQLite на число параметров)
+DELETE_BATCH_SIZE = 500
+
+
+def _to_price(value):
+    """Приводит цену к виду, в котором она хранится в PriceList.price."""
+    price = PriceList._meta.get_field("price").to_python(float(value))
+    return price.quantize(Decimal("0.01"))
+
+
+def _with_occurrence(keys):
+    """Нумерует повторы ключей, чтобы одинаковые позиции в прайсе не схлопывались."""
+    seen = Counter()
+    for key in keys:
+        seen[key] += 1
+        yield (*key, seen[key])
+
+
+def save_price_lists(df, filename, generation):
     """
-    Сохраняет прайс-лист в базу данных.
+    Сохраняет прайс-лист в базу данных под новым поколением, сверяя его со
+    строками поставщика: новые позиции и новые цены добавляются с отметкой
+    valid_from, пропавшие позиции и старые цены закрываются отметкой valid_to.
+    Пока поколение не опубликовано, читатели видят прежние данные.
+    Всё выполняется в одной транзакции.
 
     :param df: DataFrame с данными
     :param filename: название файла
+    :param generation: номер поколения, под которым пишутся изменения
     """
     brand_dict = get_brand_id_dict()
     logger.info("Сохранение прайс-листа %s в базу данных...", filename)
@@ -374,39 +487,71 @@ def save_price_lists(df, filename):
         logger.warning("⚠️ Поставщик не найден в базе данных.")
         return
 
-    # Создаем список новых продуктов и прайс-листов
-    product_bases_to_create = []
-    price_lists_to_create = []
-
-    for _, row in df.iterrows():
-        brand_name = row["brand"]
-        name = row["name"]
-        price = row[f"price_{filename}"]
-
+    # Что должно быть в базе: (бренд, название, номер повтора) → цена
+    rows = []
+    for brand_name, name, price in zip(
+        df["brand"], df["name"], df[f"price_{filename}"]
+    ):
         if brand_name is not None:  # проверка, что brand_name не None
             brand_id = brand_dict.get(brand_name)
             if not brand_id:
                 logger.warning(f"⚠️ Бренд '{brand_name}' не найден в базе данных.")
                 continue
+            rows.append(((brand_id, name), _to_price(price)))
+    wanted = dict(
+        zip(_with_occurrence(key for key, _ in rows), (price for _, price in rows))
+    )
 
-            # Создaем экземпляр ProductBase и добавляем его в список
-            product_base = ProductBase(raw_name=name, brand_id=brand_id)
-            product_bases_to_create.append(product_base)
+    # Что сейчас действует: тот же ключ → (id строки, цена)
+    stored_rows = list(
+        PriceList.objects.filter(supplier=supplier, valid_to__isnull=True)
+        .order_by("id")
+        .values_list("product__brand_id", "product__raw_name", "id", "price")
+    )
+    stored = dict(
+        zip(
+            _with_occurrence((brand_id, name) for brand_id, name, _, _ in stored_rows),
+            ((price_list_id, price) for _, _, price_list_id, price in stored_rows),
+        )
+    )
 
-            # Создаем экземпляр PriceList и добавляем его в список
-            price_list = PriceList(supplier_id=supplier.id, price=price)
-            price_lists_to_create.append(price_list)
+    # Изменение цены — это закрытие старой строки и добавление новой
+    inserted = [
+        key for key in wanted if stored.get(key, (None, None))[1] != wanted[key]
+    ]
+    closed = [
+        price_list_id
+        for key, (price_list_id, price) in stored.items()
+        if wanted.get(key) != price
+    ]
 
-    # Массовое создание продуктов
-    created_product_bases = ProductBase.objects.bulk_create(product_bases_to_create)
+    with transaction.atomic():
+        for i in range(0, len(closed), DELETE_BATCH_SIZE):
+            PriceList.objects.filter(id__in=closed[i : i + DELETE_BATCH_SIZE]).update(
+                valid_to=generation
+            )
 
-    # Устанавливаем продукты для соответствующих прайс-листов
-    for price_list, product_base in zip(price_lists_to_create, created_product_bases):
-        price_list.product = product_base
+        created_product_bases = ProductBase.objects.bulk_create(
+            [
+                ProductBase(raw_name=name, brand_id=brand_id)
+                for brand_id, name, _ in inserted
+            ]
+        )
+        PriceList.objects.bulk_create(
+            [
+                PriceList(
+                    product=product_base,
+                    supplier=supplier,
+                    price=wanted[key],
+                    valid_from=generation,
+                )
+                for key, product_base in zip(inserted, created_product_bases)
+            ]
+        )
 
-    # Массовое создание прайс-листов
-    PriceList.objects.bulk_create(price_lists_to_create)
-    logger.debug(f"Создано {len(price_lists_to_create)} прайс-листов.")
+    logger.debug(
+        "%s: добавлено %s, закрыто %s позиций.", filename, len(inserted), len(closed)
+    )
 
 
 def save_unique_brands(unique_brands: List[str]) -> None:
@@ -452,26 +597,32 @@ def get_brand_id_dict():
     return {brand.name: brand.id for brand in Brand.objects.all()}
 
 
-def find_xlsx_files(directory_path):
-    """Возвращает список всех .xlsx файлов в указанной папке."""
+def find_price_files(directory_path):
+    """
+    Возвращает список всех .xlsx и .xls файлов в указанной папке.
+    Если у поставщика есть оба варианта, берётся .xlsx.
+    """
     target_dir = Path(directory_path)
-    file_paths = [
-        file for file in target_dir.glob("*.xlsx") if not file.name.startswith("~")
-    ]
+    files_by_stem = {}
+    for pattern in ("*.xls", "*.xlsx"):
+        for file in sorted(target_dir.glob(pattern)):
+            if not file.name.startswith("~"):
+                files_by_stem[file.stem] = file
+    file_paths = sorted(files_by_stem.values())
 
     if not file_paths:
-        logger.info("В указанной папке %s нет файлов .xlsx.", target_dir)
+        logger.info("В указанной папке %s нет файлов .xlsx и .xls.", target_dir)
         return []
 
-    logger.info(f"Найдено {len(file_paths)} файлов .xlsx для обработки.")
+    logger.info(f"Найдено {len(file_paths)} файлов Excel для обработки.")
     return file_paths
 
 
-def process_file(file_path):
+def process_file(file_path, usd_rate=None):
     """Обрабатывает один файл прайс-листа."""
     logger.debug("Обработка файла: %s", file_path.name)
     try:
-        df = process_price_list(file_path)
+        df = process_price_list(file_path, usd_rate)
         if df is None:
             logger.warning(
                 f"⚠️ Пропущен файл {file_path.name} из-за отсутствия подходящих колонок."
@@ -485,6 +636,218 @@ def process_file(file_path):
         return None
 
 
+def get_parser_workers(workers=None):
+    """Количество процессов для разбора: аргумент или PRICE_PARSER_WORKERS."""
+    return PARSER_WORKERS if workers is None else workers
+
+
+def _run_in_parser_worker(fn, args, kwargs):
+    """
+    Задача в процессе ParserPool. Процессов разбора и так по числу ядер,
+    поэтому нечёткий поиск брендов в каждом из них идёт в один поток.
+    """
+    brand_resolver.workers = 1
+    return fn(*args, **kwargs)
+
+
+class ParserPool(Executor):
+    """
+    Пул процессов разбора с интерфейсом concurrent.futures на billiard.
+
+    Обновление цен идёт в воркере Celery prefork, а он демонический:
+    ProcessPoolExecutor и multiprocessing.Pool там падают с «daemonic
+    processes are not allowed to have children». Пул billiard (на нём
+    работает сам Celery) дочерние процессы из демона запускать умеет,
+    а потерю процесса разбора отдаёт как WorkerLostError, а не зависанием.
+
+    Процессы запускаются через spawn: в конвейере почты пул поднимается из
+    работающего цикла asyncio, где уже есть потоки, а дочерний процесс,
+    полученный fork многопоточного, может зависнуть на унаследованной
+    блокировке. Новый процесс начинает с чистого интерпретатора, поэтому
+    сначала настраивает Django: этот модуль импортирует модели.
+    """
+
+    def __init__(self, workers):
+        self._pool = billiard.get_context("spawn").Pool(
+            workers, initializer=django.setup
+        )
+        self._futures = set()
+
+    def submit(self, fn, /, *args, **kwargs):
+        future = Future()
+
+        def done(set_outcome, outcome):
+            self._futures.discard(future)
+            if future.set_running_or_notify_cancel():
+                set_outcome(outcome)
+
+        def failed(einfo):
+            # billiard отдаёт ExceptionInfo; исключение из дочернего процесса
+            # приходит в нём уже распакованным, а потерю процесса
+            # (WorkerLostError) пул оборачивает на месте
+            error = einfo.exception
+            done(future.set_exception, getattr(error, "exc", error))
+
+        self._futures.add(future)
+        self._pool.apply_async(
+            _run_in_parser_worker,
+            (fn, args, kwargs),
+            callback=partial(done, future.set_result),
+            error_callback=failed,
+        )
+        return future
+
+    def shutdown(self, wait=True, *, cancel_futures=False):
+        if cancel_futures:
+            for future in list(self._futures):
+                future.cancel()
+            self._pool.terminate()
+        else:
+            self._pool.close()
+        if wait:
+            self._pool.join()
+
+
+def process_files(file_paths, workers=None, usd_rate=None, executor=None):
+    """
+    Обрабатывает файлы прайс-листов и возвращает результаты в том же порядке.
+
+    Курс валюты читается из базы один раз, дальше разбор идёт только на pandas,
+    поэтому при workers > 1 файлы разбираются в пуле процессов без доступа к БД.
+
+    :param executor: уже открытый пул процессов (конвейер почты), вместо нового
+    """
+    if usd_rate is None:
+        usd_rate = get_currency_rate("USD")
+
+    if executor is not None:
+        if file_paths:
+            logger.info("Обработка %s файлов в пуле конвейера почты", len(file_paths))
+        return list(executor.map(process_file, file_paths, repeat(usd_rate)))
+
+    workers = get_parser_workers(workers)
+    if workers <= 1 or len(file_paths) < 2:
+        return [process_file(file_path, usd_rate) for file_path in file_paths]
+
+    workers = min(workers, len(file_paths))
+    logger.info(
+        "Параллельная обработка %s файлов, процессов: %s", len(file_paths), workers
+    )
+    # Открытые соединения с БД не должны наследоваться дочерними процессами
+    connections.close_all()
+    with ParserPool(workers) as executor:
+        return list(executor.map(process_file, file_paths, repeat(usd_rate)))
+
+
+def file_sha256(file_path) -> str:
+    with open(file_path, "rb") as f:
+        return hashlib.file_digest(f, "sha256").hexdigest()
+
+
+def get_parse_context(usd_rate) -> str:
+    """
+    Всё, от чего кроме самого файла зависит результат разбора: версия
+    разбора, курс (для рублёвых прайсов) и размер справочника брендов.
+    """
+    return (
+        f"parser={PARSER_VERSION};usd={usd_rate};"
+        f"brands={len(unique_brands)};synonyms={len(brand_synonyms)}"
+    )
+
+
+def _frame_to_json(df):
+    if df is None:
+        return None
+    return {"columns": list(df.columns), "data": df.values.tolist()}
+
+
+def _frame_from_json(data):
+    if data is None:
+        return None
+    return pd.DataFrame(data["data"], columns=data["columns"])
+
+
+def process_changed_files(
+    file_paths, workers=None, prefetched=None, executor=None, usd_rate=None
+):
+    """
+    Разбирает только файлы, содержимое которых изменилось с прошлого обновления.
+    Для остальных берётся сохранённый результат разбора. Хэши файлов, которые
+    почта сохранила и с тех пор не трогали, берутся из манифеста вложений.
+
+    :param prefetched: {путь: (sha256, контекст, Future)} — разборы, запущенные
+        ещё во время скачивания почты; берутся, если хэш и контекст совпали
+    :param executor: пул процессов, в котором разбирать остальные файлы
+    :param usd_rate: курс обновления; если не передан, берётся из базы данных
+    :return: (результаты в порядке file_paths, {имя файла: новое состояние PriceFile})
+    """
+    if usd_rate is None:
+        usd_rate = get_currency_rate("USD")
+    context = get_parse_context(usd_rate)
+    saved = PriceFile.objects.in_bulk(
+        [file_path.stem for file_path in file_paths], field_name="source"
+    )
+
+    known_hashes = {}
+    for directory in {file_path.parent for file_path in file_paths}:
+        known_hashes.update(
+            {
+                directory / name: sha256
+                for name, sha256 in get_price_file_hashes(directory).items()
+            }
+        )
+
+    results = {}
+    changed = {}
+    for file_path in file_paths:
+        sha256 = known_hashes.get(file_path) or file_sha256(file_path)
+        state = saved.get(file_path.stem)
+        if state and state.sha256 == sha256 and state.context == context:
+            logger.info("Файл %s не изменился, разбор пропущен.", file_path.name)
+            results[file_path] = _frame_from_json(state.parsed)
+        else:
+            changed[file_path] = PriceFile(
+                source=file_path.stem, sha256=sha256, context=context
+            )
+
+    prefetched = prefetched or {}
+    pending = [
+        file_path
+        for file_path, state in changed.items()
+        if prefetched.get(file_path, ())[:2] != (state.sha256, context)
+    ]
+    parsed = dict(zip(pending, process_files(pending, workers, usd_rate, executor)))
+    for file_path, state in changed.items():
+        if file_path in parsed:
+            df = parsed[file_path]
+        else:
+            logger.debug("Файл %s разобран во время скачивания почты.", file_path.name)
+            try:
+                df = prefetched[file_path][2].result()
+            except Exception as e:
+                logger.warning(
+                    "Разбор %s в пуле не удался (%s), разбираем заново.",
+                    file_path.name,
+                    e,
+                )
+                df = process_file(file_path, usd_rate)
+        results[file_path] = df
+        state.parsed = _frame_to_json(df)
+
+    states = {file_path.stem: state for file_path, state in changed.items()}
+    return [results[file_path] for file_path in file_paths], states
+
+
+def save_price_file_states(states):
+    """Запоминает хэши и результаты разбора изменившихся файлов."""
+    PriceFile.objects.bulk_create(
+        states.values(),
+        update_conflicts=True,
+        unique_fields=["source"],
+        update_fields=["sha256", "context", "parsed", "updated"],
+    )
+
+
 def merge_dataframes(dataframes):
     """Объединяет список DataFrame в один."""
     combined_df = dataframes[0]
@@ -503,33 +866,96 @@ def log_brand_info(combined_df):
     save_unique_brands(brands)
 
 
-def save_combined_data(combined_df, all_prices):
-    """Сохраняет объединённые данные и удаляет старые прайс-листы."""
-    deleted = PriceList.objects.all().delete()
-    deleted_ProductBase = ProductBase.objects.all().delete()
-    logger.debug(f"Удалено {deleted[0]} прайс-листов")
+def start_price_generation():
+    """
+    Открывает новое поколение прайс-листов.
+
+    Если предыдущее обновление упало до публикации, его недописанные строки
+    удаляются, а закрытые им строки снова становятся действующими.
+    """
+    current = PriceGeneration.current_number()
+    ProductBase.objects.filter(price_lists__valid_from__gt=current).delete()
+    PriceList.objects.filter(valid_to__gt=current).update(valid_to=None)
+    PriceGeneration.objects.filter(published=False).delete()
+    return PriceGeneration.objects.create().pk
+
+
+def publish_price_generation(generation):
+    """
+    Публикует поколение одним UPDATE: с этого момента читатели видят новые
+    данные целиком. Затем удаляет строки, закрытые до предыдущего поколения, —
+    предыдущее остаётся для запросов, начатых до публикации.
+    """
+    previous = PriceGeneration.current_number()
+    PriceGeneration.objects.filter(pk=generation).update(published=True)
+
+    deleted = ProductBase.objects.filter(price_lists__valid_to__lte=previous).delete()
+    ProductBase.objects.filter(price_lists__isnull=True).delete()
+    PriceGeneration.objects.filter(pk__lt=generation).delete()
+    logger.debug(f"Удалено {deleted[0]} устаревших записей")
+
+
+def save_combined_data(combined_df, all_prices, changed_sources=None):
+    """
+    Сохраняет объединённые данные новым поколением, сверяя каждого поставщика
+    с базой, и публикует его, когда все поставщики записаны.
+
+    Если передан changed_sources, сверяются только эти поставщики, а также
+    поставщики без действующих строк: их файл мог пропасть и вернуться тем же
+    самым, и тогда по хэшу он не считается изменившимся. Строки поставщиков,
+    чьих файлов больше нет, закрываются.
+    """
+    generation = start_price_generation()
+
+    closed = (
+        PriceList.objects.filter(valid_to__isnull=True)
+        .exclude(supplier__email__in=set(all_prices))
+        .update(valid_to=generation)
+    )
+    logger.debug(f"Закрыто {closed} записей поставщиков без прайса")
+
+    if changed_sources is not None:
+        with_rows = (
+            PriceList.objects.filter(
+                valid_to__isnull=True, supplier__email__in=set(all_prices)
+            )
+            .values_list("supplier__email", flat=True)
+            .distinct()
+        )
+        changed_sources = set(changed_sources) | (set(all_prices) - set(with_rows))
 
     for file_name, df in all_prices.items():
-        save_price_lists(df, file_name)
+        if changed_sources is None or file_name in changed_sources:
+            save_price_lists(df, file_name, generation)
 
+    publish_price_generation(generation)
     logger.debug(f"Колонки в объединённом прайс-листе: {combined_df.columns}")
 
 
-def merge_price_lists(directory_path):
-    """Ищет все файлы .xlsx, обрабатывает их и объединяет в одну таблицу."""
-    if not format_xls_to_xlsx(directory_path):
+def merge_price_lists(
+    directory_path, workers=None, prefetched=None, executor=None, usd_rate=None
+):
+    """
+    Ищет все файлы .xlsx и .xls, обрабатывает их и объединяет в одну таблицу.
+
+    :param workers: количество процессов для разбора (по умолчанию PRICE_PARSER_WORKERS)
+    :param prefetched, executor, usd_rate: см. process_changed_files
+    """
+    # .xls разбираются напрямую, поэтому только приводим имена файлов
+    if not format_xls_to_xlsx(directory_path, convert=False):
         return None
 
-    file_paths = find_xlsx_files(directory_path)
+    file_paths = find_price_files(directory_path)
     if not file_paths:
         return None
 
     all_data = []
     all_prices = {}
 
-    for file_path in file_paths:
-        # if 'nicheperfume' in str(file_path):
-        df = process_file(file_path)
+    results, states = process_changed_files(
+        file_paths, workers, prefetched, executor, usd_rate
+    )
+    for file_path, df in zip(file_paths, results):
         if df is not None:
             all_data.append(df)
             all_prices[file_path.stem] = df
@@ -541,11 +967,78 @@ def merge_price_lists(directory_path):
     combined_df = merge_dataframes(all_data)
     log_brand_info(combined_df)
 
-    save_combined_data(combined_df, all_prices)
+    save_combined_data(combined_df, all_prices, changed_sources=set(states))
+    # состояния сохраняем только после записи в БД, иначе при сбое
+    # следующий запуск посчитает файлы уже загруженными
+    save_price_file_states(states)
 
     return combined_df
 
 
+def merge_price_lists_from_mail(directory_path, workers=None):
+    """
+    Обновляет прайсы из почты и объединяет их конвейером: каждый изменившийся
+    прайс уходит на разбор в пул процессов, как только лёг на диск, и
+    разбирается, пока качаются остальные. Обновление занимает примерно
+    max(скачивание, разбор) вместо их суммы. При одном процессе разбора
+    почта и разбор идут по очереди.
+
+    :return: объединённая таблица или None, если обновить или объединить не удалось
+    """
+    workers = get_parser_workers(workers)
+    # один курс на всё обновление, даже если его поменяют во время разбора
+    usd_rate = get_currency_rate("USD")
+    if workers <= 1:
+        if not renew_prices_from_mail():
+            logger.error("Не удалось обновить прайс-листы из почты")
+            return None
+        return merge_price_lists(directory_path, workers, usd_rate=usd_rate)
+
+    context = get_parse_context(usd_rate)
+    saved = {
+        source: (sha256, saved_context)
+        for source, sha256, saved_context in PriceFile.objects.values_list(
+            "source", "sha256", "context"
+        )
+    }
+    prefetched = {}
+    pool_failed = False
+
+    def on_saved(file_path, sha256):
+        nonlocal pool_failed
+        file_path = Path(file_path)
+        if pool_failed or saved.get(file_path.stem) == (sha256, context):
+            return
+        try:
+            future = executor.submit(process_file, file_path, usd_rate)
+        except Exception as e:
+            # ошибка пула не должна срывать скачивание почты: файлы
+            # разберутся после него
+            logger.warning(
+                "Не удалось отправить %s на разбор во время скачивания: %s",
+                file_path.name,
+                e,
+            )
+            pool_failed = True
+            return
+        logger.debug("Файл %s скачан и отправлен на разбор.", file_path.name)
+        prefetched[file_path] = (sha256, context, future)
+
+    # Открытые соединения с БД не должны наследоваться дочерними процессами
+    connections.close_all()
+    with ParserPool(workers) as executor:
+        if not renew_prices_from_mail(on_saved=on_saved):
+            logger.error("Не удалось обновить прайс-листы из почты")
+            executor.shutdown(cancel_futures=True)
+            return None
+        if pool_failed:
+            executor.shutdown(cancel_futures=True)
+            return merge_price_lists(directory_path, 1, usd_rate=usd_rate)
+        return merge_price_lists(
+            directory_path, workers, prefetched, executor, usd_rate
+        )
+
+
 def format_price_list(file_path):
     # Открытие Excel-файла для изменения ширины колонок
     workbook = load_workbook(file_path)
@@ -608,14 +1101,11 @@ def save_combined_price(result, dir_path):
 
 def main() -> bool:
 
-    # Идем на почту, если не нужно ходить на почту - комментруем
-    if not renew_prices_from_mail():
-        logger.error("Не удалось обновить прайс-листы из почты")
-        return False
-
     dir_path = "../" + os.getenv("SAVE_DIR")
     logger.info("Директория: %s", dir_path)
-    result = merge_price_lists(dir_path)
+    # Идем на почту и разбираем прайсы по мере скачивания; если не нужно
+    # ходить на почту - вызываем merge_price_lists(dir_path)
+    result = merge_price_lists_from_mail(dir_path)
     output_path = "../" + os.getenv("OUTPUT_DIR")
     if result is not None:
         # result.to_excel("combined_price_list.xlsx", index=False)
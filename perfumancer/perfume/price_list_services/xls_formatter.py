@@ -4,9 +4,12 @@ import pandas as pd
 import logging
 
 
-def format_xls_to_xlsx(directory_path: str) -> bool:
+def format_xls_to_xlsx(directory_path: str, convert: bool = True) -> bool:
     """
     Конвертирует все файлы .xls в указанной директории в .xlsx.
+
+    При convert=False только приводит имена файлов к нижнему регистру:
+    парсер читает .xls напрямую через xlrd, и конвертация не нужна.
     """
     target_dir = Path(directory_path)
 
@@ -29,6 +32,7 @@ def format_xls_to_xlsx(directory_path: str) -> bool:
     # Флаг для фиксации успешной конвертации
     conversion_successful = False
     xlsx_files_exist = False
+    xls_files_exist = False
 
     for file_name in os.listdir(target_dir):
         file_path = target_dir / file_name
@@ -41,6 +45,10 @@ def format_xls_to_xlsx(directory_path: str) -> bool:
             logging.debug("пропущен неподходящий файл: %s", file_name)
             continue
 
+        if not convert:
+            xls_files_exist = True
+            continue
+
         xlsx_file_path = file_path.with_suffix(".xlsx")
 
         # Конвертируем файл
@@ -48,7 +56,7 @@ def format_xls_to_xlsx(directory_path: str) -> bool:
             remove_file(file_path)
             conversion_successful = True
 
-    if not conversion_successful and not xlsx_files_exist:
+    if not conversion_successful and not xlsx_files_exist and not xls_files_exist:
         logging.debug("подходящих файлов для конвертации не найдено и файлов .xlsx нет.")
         return False
 
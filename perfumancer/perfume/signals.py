@@ -1,7 +1,16 @@
-from django.db.models.signals import pre_save, post_save
+from django.db.models.signals import pre_save, post_save, post_delete
 from django.dispatch import receiver
 from django.db import transaction
-from .models import Order, Receipt, ReceiptItem, ReceiptStatus
+from .models import CurrencyRate, Order, Receipt, ReceiptItem, ReceiptStatus
+
+
+@receiver([post_save, post_delete], sender=CurrencyRate)
+def clear_currency_rate_cache(sender, **kwargs):
+    """
+    Сбрасывает кэш курсов текущего процесса. Кэш локальный (LocMemCache),
+    поэтому другие процессы увидят новый курс не позже чем через CACHE_TTL.
+    """
+    CurrencyRate.clear_cache()
 
 
 @receiver(pre_save, sender=Order)
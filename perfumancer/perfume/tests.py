@@ -1,3 +1,461 @@
-from django.test import TestCase
+import asyncio
+import base64
+import hashlib
+import os
+import re
+import tempfile
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+import aioimaplib
+import billiard
+import pandas as pd
+from django.test import SimpleTestCase, TestCase
+
+from .models import Brand, CurrencyRate, PriceGeneration, PriceList, ProductBase
+from .price_list_services import mail
+from .price_list_services.brand import brand_resolver
+from .price_list_services.mail import (
+    BodyPart,
+    IMAPConnectionPool,
+    download_part,
+    fetch_message_senders,
+    group_fetch_responses,
+    parse_bodystructure,
+    parse_fetch_response,
+)
+from .price_list_services.simple_parser import (
+    ParserPool,
+    publish_price_generation,
+    save_combined_data,
+    save_price_lists,
+    start_price_generation,
+)
+
+
+def price_frame(source, rows):
+    """Результат разбора прайса: [(бренд, название, цена), ...]."""
+    return pd.DataFrame(rows, columns=["brand", "name", f"price_{source}"])
+
+
+class PriceGenerationTests(TestCase):
+    source = "a@mail.ru"
+
+    def setUp(self):
+        Brand.objects.create(name="CHANEL")
+
+    def write(self, price):
+        """Записывает прайс новым поколением, не публикуя его."""
+        generation = start_price_generation()
+        save_price_lists(
+            price_frame(
+                self.source,
+                [("CHANEL", "no 5 edp 100", price), ("CHANEL", "chance edt 50", 80)],
+            ),
+            self.source,
+            generation,
+        )
+        return generation
+
+    def publish(self, price):
+        generation = self.write(price)
+        publish_price_generation(generation)
+        return generation
+
+    def prices(self, queryset):
+        return sorted(int(price) for price in queryset.values_list("price", flat=True))
+
+    def test_generation_is_visible_only_after_publish(self):
+        generation = self.write(120)
+        self.assertEqual(PriceGeneration.current_number(), 0)
+        self.assertEqual(self.prices(PriceList.objects.current()), [])
+
+        publish_price_generation(generation)
+        self.assertEqual(PriceGeneration.current_number(), generation)
+        self.assertEqual(self.prices(PriceList.objects.current()), [80, 120])
+
+    def test_price_change_closes_old_row_and_inserts_new_one(self):
+        first = self.publish(120)
+        second = self.write(130)
+
+        # до публикации читатели видят прежнюю цену
+        self.assertEqual(self.prices(PriceList.objects.current()), [80, 120])
+        old = PriceList.objects.get(price=120)
+        new = PriceList.objects.get(price=130)
+        self.assertEqual((old.valid_from, old.valid_to), (first, second))
+        self.assertEqual((new.valid_from, new.valid_to), (second, None))
+        # неизменившаяся позиция не переписывается
+        self.assertEqual(PriceList.objects.filter(price=80).count(), 1)
+
+        publish_price_generation(second)
+        self.assertEqual(self.prices(PriceList.objects.current()), [80, 130])
+        self.assertEqual(self.prices(PriceList.objects.visible_in(first)), [80, 120])
+
+    def test_unpublished_generation_is_rolled_back_by_next_run(self):
+        first = self.publish(120)
+        self.write(130)  # обновление упало до публикации
+
+        generation = start_price_generation()
+        self.assertEqual(self.prices(PriceList.objects.all()), [80, 120])
+        self.assertFalse(PriceList.objects.filter(valid_to__isnull=False).exists())
+        self.assertEqual(ProductBase.objects.count(), 2)
+        self.assertEqual(
+            list(PriceGeneration.objects.values_list("pk", "published")),
+            [(first, True), (generation, False)],
+        )
+
+    def test_publish_keeps_exactly_one_previous_generation(self):
+        self.publish(120)
+        second = self.publish(130)
+        self.publish(140)
+
+        # строки второго поколения остаются для запросов, начатых до публикации
+        self.assertEqual(self.prices(PriceList.objects.all()), [80, 130, 140])
+        self.assertEqual(self.prices(PriceList.objects.visible_in(second)), [80, 130])
+        self.assertEqual(self.prices(PriceList.objects.current()), [80, 140])
+        self.assertEqual(ProductBase.objects.count(), 3)
+        self.assertEqual(PriceGeneration.objects.count(), 1)
+
+
+class SaveCombinedDataTests(TestCase):
+    def setUp(self):
+        Brand.objects.create(name="CHANEL")
+        self.prices = {
+            "a@mail.ru": price_frame(
+                "a@mail.ru",
+                [("CHANEL", "no 5 edp 100", 120), ("CHANEL", "chance edt 50", 80)],
+            ),
+            "b@mail.ru": price_frame("b@mail.ru", [("CHANEL", "allure edp 50", 95)]),
+        }
+
+    def save(self, sources, changed_sources):
+        all_prices = {source: self.prices[source] for source in sources}
+        save_combined_data(pd.concat(all_prices.values()), all_prices, changed_sources)
+
+    def current_count(self, source):
+        return PriceList.objects.current().filter(supplier__email=source).count()
+
+    def test_returned_file_is_saved_again_with_the_same_hash(self):
+        self.save(["a@mail.ru", "b@mail.ru"], {"a@mail.ru", "b@mail.ru"})
+        self.assertEqual(self.current_count("a@mail.ru"), 2)
+
+        # файл поставщика пропал: его строки закрываются
+        self.save(["b@mail.ru"], set())
+        self.assertEqual(self.current_count("a@mail.ru"), 0)
+
+        # тот же файл вернулся: по хэшу он не менялся, но строк у поставщика нет
+        self.save(["a@mail.ru", "b@mail.ru"], set())
+        self.assertEqual(self.current_count("a@mail.ru"), 2)
+        self.assertEqual(self.current_count("b@mail.ru"), 1)
+
+
+def cdist_threads():
+    return brand_resolver.workers
+
+
+class ParserPoolTests(SimpleTestCase):
+    def test_results_and_errors_come_back_as_futures(self):
+        with ParserPool(2) as pool:
+            self.assertEqual(list(pool.map(abs, [-1, 2, -3])), [1, 2, 3])
+            future = pool.submit(int, "не число")
+            with self.assertRaises(ValueError):
+                future.result(timeout=60)
+
+    def test_fuzzy_brand_search_is_single_threaded_in_workers(self):
+        with ParserPool(1) as pool:
+            self.assertEqual(pool.submit(cdist_threads).result(timeout=60), 1)
+        self.assertEqual(brand_resolver.workers, -1)
+
+    def test_pool_starts_inside_daemonic_process(self):
+        # так работает воркер Celery prefork
+        with mock.patch.dict(billiard.current_process()._config, daemon=True):
+            with ParserPool(1) as pool:
+                self.assertEqual(pool.submit(abs, -5).result(timeout=60), 5)
+
+
+class CurrencyRateTests(TestCase):
+    def test_uncached_rate_sees_change_from_another_process(self):
+        CurrencyRate.objects.create(currency="USD", rate=90)
+        self.assertEqual(CurrencyRate.get_rate("USD"), 90)
+
+        # другой процесс меняет курс: сигнал сбросит только его кэш
+        CurrencyRate.objects.filter(currency="USD").update(rate=100)
+        self.assertEqual(CurrencyRate.get_rate("USD"), 90)
+        self.assertEqual(CurrencyRate.get_rate("USD", cached=False), 100)
+
+
+class FakeConnection:
+    def __init__(self):
+        self.closed = False
+
+    async def logout(self):
+        self.closed = True
+
+
+class IMAPConnectionPoolTests(SimpleTestCase):
+    def use_connection(self, error):
+        pool = IMAPConnectionPool("imap.example.com", "user", "password")
+        conn = FakeConnection()
+
+        async def create_connection():
+            return conn
+
+        pool._create_connection = create_connection
+
+        async def run():
+            try:
+                async with pool.connection():
+                    if error:
+                        raise error
+            except BaseException:
+                pass
+            return pool.connections.qsize()
+
+        return conn, asyncio.run(run())
+
+    def test_connection_returns_to_pool_after_success(self):
+        conn, pooled = self.use_connection(None)
+        self.assertEqual(pooled, 1)
+        self.assertFalse(conn.closed)
+
+    def test_connection_is_closed_after_any_error(self):
+        for error in (
+            TimeoutError(),
+            RuntimeError("ошибка протокола"),
+            asyncio.CancelledError(),
+        ):
+            with self.subTest(error=type(error).__name__):
+                conn, pooled = self.use_connection(error)
+                self.assertEqual(pooled, 0)
+                self.assertTrue(conn.closed)
+
+
+# Ответы FETCH в том виде, в каком их отдаёт aioimaplib: строка с литералом
+# заканчивается на {N}, сам литерал — bytearray, остаток строки — следующий
+# элемент, последний элемент — текст статуса команды
+LITERAL_NAME = "Прайс.xls".encode()
+
+FETCH_FORWARDED = [
+    # multipart/alternative внутри mixed, имя файла литералом и по RFC 2231
+    b'7 FETCH (UID 42 BODYSTRUCTURE ((("text" "plain" ("charset" "utf-8") NIL NIL'
+    b' "7bit" 30 2 NIL NIL NIL NIL)("text" "html" ("charset" "utf-8") NIL NIL'
+    b' "quoted-printable" 80 3 NIL NIL NIL NIL) "alternative" ("boundary" "alt")'
+    b' NIL NIL)("application" "vnd.ms-excel" ("name" {%d}' % len(LITERAL_NAME),
+    bytearray(LITERAL_NAME),
+    b') NIL NIL "base64" 40960 NIL ("attachment" ("filename*0*"'
+    b' "utf-8\'\'%D0%9F%D1%80%D0%B0%D0%B9%D1%81%20" "filename*1*" "%D0%BE%D1%82%2001.10"'
+    b' "filename*2" ".xlsx")) NIL NIL)'
+    # пересланное письмо: конверт, затем его собственная структура
+    b'("message" "rfc822" NIL NIL NIL "7bit" 2345 ("Mon, 7 Oct 2024 21:52:25 +0300"'
+    b' "Fwd: \\"price\\" (1)" (("Supplier" NIL "price" "example.com"))'
+    b' (("Supplier" NIL "price" "example.com")) (("Supplier" NIL "price" "example.com"))'
+    b' ((NIL NIL "prices" "example.com")) NIL NIL NIL "<1@example.com>")'
+    b' (("text" "plain" ("charset" "utf-8") NIL NIL "7bit" 12 1 NIL NIL NIL NIL)'
+    b'("application" "octet-stream" ("name" "=?utf-8?B?0J/RgNCw0LnRgS54bHN4?=") NIL NIL'
+    b' "base64" 1000 NIL ("attachment" ("filename*" "windows-1251\'\'%CF%F0%E0%E9%F1.xls"))'
+    b' NIL NIL) "mixed" ("boundary" "inner") NIL NIL) 40 NIL NIL NIL NIL)'
+    b' "mixed" ("boundary" "outer") NIL NIL))',
+    b"Fetch completed (0.001 + 0.000 secs).",
+]
+
+
+class FetchResponseParsingTests(SimpleTestCase):
+    def parts(self, lines):
+        (response_part,) = group_fetch_responses(lines)
+        return parse_bodystructure(parse_fetch_response(response_part)["BODYSTRUCTURE"])
+
+    def test_nested_multipart_and_forwarded_message_sections(self):
+        self.assertEqual(
+            self.parts(FETCH_FORWARDED),
+            [
+                BodyPart("1.1", "text/plain", None, 30, "7bit", None),
+                BodyPart("1.2", "text/html", None, 80, "quoted-printable", None),
+                BodyPart(
+                    "2",
+                    "application/vnd.ms-excel",
+                    "Прайс от 01.10.xlsx",
+                    40960,
+                    "base64",
+                    "attachment",
+                ),
+                BodyPart("3.1", "text/plain", None, 12, "7bit", None),
+                BodyPart(
+                    "3.2",
+                    "application/octet-stream",
+                    "Прайс.xls",
+                    1000,
+                    "base64",
+                    "attachment",
+                ),
+            ],
+        )
+
+    def test_single_part_message_and_forwarded_single_part(self):
+        single = [
+            b'3 FETCH (UID 9 BODYSTRUCTURE ("application" "vnd.openxmlformats-'
+            b'officedocument.spreadsheetml.sheet" ("name" "=?utf-8?B?0J/RgNCw0LnRgS54bHN4?=")'
+            b' NIL NIL "base64" 2048 NIL ("attachment" NIL) NIL NIL))',
+            b"Success",
+        ]
+        self.assertEqual(
+            self.parts(single),
+            [
+                BodyPart(
+                    "1",
+                    "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+                    "Прайс.xlsx",
+                    2048,
+                    "base64",
+                    "attachment",
+                )
+            ],
+        )
+
+        forwarded = [
+            b'4 FETCH (UID 10 BODYSTRUCTURE (("text" "plain" ("charset" "utf-8") NIL NIL'
+            b' "7bit" 5 1 NIL NIL NIL NIL)("message" "rfc822" NIL NIL NIL "7bit" 500'
+            b' (NIL "price" NIL NIL NIL NIL NIL NIL NIL NIL) ("application" "vnd.ms-excel"'
+            b' NIL NIL NIL "base64" 300 NIL ("attachment" ("filename" "price \\"new\\".xls"))'
+            b' NIL NIL) 10 NIL NIL NIL NIL) "mixed" ("boundary" "b") NIL NIL))',
+            b"Success",
+        ]
+        self.assertEqual(
+            self.parts(forwarded)[1],
+            BodyPart(
+                "2.1",
+                "application/vnd.ms-excel",
+                'price "new".xls',
+                300,
+                "base64",
+                "attachment",
+            ),
+        )
+
+    def test_fetch_items_with_literals(self):
+        header = b"From: =?utf-8?b?0J/QvtGB0YLQsNCy0YnQuNC6?= <sup@mail.ru>\r\n\r\n"
+        lines = [
+            b"1 FETCH (UID 5 BODY[HEADER.FIELDS (FROM SUBJECT DATE)] {%d}"
+            % len(header),
+            bytearray(header),
+            b")",
+            b"2 FETCH (UID 6 FLAGS (\\Seen) BODY[2]<1024> {4}",
+            bytearray(b"UEsD"),
+            b")",
+            b"FETCH completed.",
+        ]
+        first, second = map(parse_fetch_response, group_fetch_responses(lines))
+        self.assertEqual(
+            first,
+            {"UID": "5", "BODY[HEADER.FIELDS (FROM SUBJECT DATE)]": bytearray(header)},
+        )
+        self.assertEqual(
+            second,
+            {"UID": "6", "FLAGS": ["\\Seen"], "BODY[2]<1024>": bytearray(b"UEsD")},
+        )
+
+    def test_group_fetch_responses_trims_status_line(self):
+        lines = [
+            b"1 FETCH (UID 5 FLAGS ())",
+            b"2 FETCH (UID 6 BODY[1] {2}",
+            bytearray(b"ok"),
+            b")",
+            b"UID FETCH completed",
+        ]
+        self.assertEqual(
+            group_fetch_responses(lines),
+            [
+                [b"1 FETCH (UID 5 FLAGS ())"],
+                [b"2 FETCH (UID 6 BODY[1] {2}", bytearray(b"ok"), b")"],
+            ],
+        )
+        # без строки статуса последний ответ остаётся целым
+        self.assertEqual(group_fetch_responses(lines[:1]), [[lines[0]]])
+        self.assertEqual(group_fetch_responses([b"No matching messages"]), [])
+
+
+class FakeFetchPool:
+    """
+    Пул, отдающий секцию письма кусками в формате aioimaplib. После литерала
+    в ответ попадает непрошеный FETCH с FLAGS другого письма, как это бывает
+    на живом ящике.
+    """
+
+    def __init__(self, raw, served=None, with_body=True):
+        self.raw = raw
+        self.served = len(raw) if served is None else served
+        self.with_body = with_body
+        self.metrics = mail.MailMetrics()
+
+    async def execute(self, command, *args, **labels):
+        offset, size = map(int, re.search(r"<(\d+)\.(\d+)>", args[-1]).groups())
+        chunk = self.raw[offset : min(offset + size, self.served)]
+        lines = [b"3 FETCH (FLAGS (\\Seen))"]
+        if self.with_body:
+            lines = [
+                b"5 FETCH (UID 42 BODY[2]<%d> {%d}" % (offset, len(chunk)),
+                bytearray(chunk),
+                b")",
+                *lines,
+            ]
+        return SimpleNamespace(result="OK", lines=[*lines, b"FETCH completed."])
+
+
+class DownloadPartTests(SimpleTestCase):
+    content = os.urandom(2250)
+    raw = base64.encodebytes(content)
+
+    def download(self, pool, size=None):
+        part = BodyPart(
+            "2",
+            "application/vnd.ms-excel",
+            "price.xls",
+            len(self.raw) if size is None else size,
+            "base64",
+            "attachment",
+        )
+        with tempfile.TemporaryDirectory() as tmp:
+            file_path = os.path.join(tmp, "price.xls")
+            try:
+                with mock.patch.object(mail, "FETCH_CHUNK_SIZE", 1000):
+                    sha256 = asyncio.run(download_part(pool, "42", part, file_path))
+            finally:
+                self.exists = os.path.exists(file_path)
+            with open(file_path, "rb") as f:
+                return sha256, f.read()
+
+    def test_unsolicited_fetch_lines_are_ignored(self):
+        sha256, data = self.download(FakeFetchPool(self.raw))
+        self.assertEqual(data, self.content)
+        self.assertEqual(sha256, hashlib.sha256(self.content).hexdigest())
+
+    def test_missing_section_is_an_error(self):
+        with self.assertRaises(aioimaplib.Error):
+            self.download(FakeFetchPool(self.raw, with_body=False))
+        self.assertFalse(self.exists)
+
+    def test_truncated_section_is_an_error(self):
+        with self.assertRaises(aioimaplib.Error):
+            self.download(FakeFetchPool(self.raw, served=len(self.raw) - 500))
+        self.assertFalse(self.exists)
+
+
+class FetchMessageSendersTests(SimpleTestCase):
+    def test_unsolicited_fetch_lines_are_skipped(self):
+        header = b"From: =?utf-8?b?0J/QvtGB0YLQsNCy0YnQuNC6?= <Sup@Mail.ru>\r\n\r\n"
+        lines = [
+            b"1 FETCH (FLAGS (\\Seen))",
+            b"2 FETCH (UID 6 BODY[HEADER.FIELDS (FROM)] {%d}" % len(header),
+            bytearray(header),
+            b")",
+            b"3 FETCH (UID 7 FLAGS (\\Seen))",
+            b"FETCH completed.",
+        ]
+
+        class Pool:
+            metrics = mail.MailMetrics()
+
+            async def execute(self, command, *args, **labels):
+                return SimpleNamespace(result="OK", lines=lines)
+
+        senders = asyncio.run(fetch_message_senders(Pool(), [6]))
+        self.assertEqual(senders, {6: "sup@mail.ru"})
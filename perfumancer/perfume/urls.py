@@ -13,4 +13,5 @@ urlpatterns = [
     path("", perfume_admin_site.urls),  # Кастомный админ-сайт
     path("renew-prices/", views.renew_prices, name="renew_prices"),
     path("download-prices/", views.download_prices, name="download_prices"),
+    path("mail-metrics/", views.mail_metrics, name="mail_metrics"),
 ]
@@ -5,6 +5,7 @@ from django.contrib.admin.views.decorators import staff_member_required
 
 from .tasks import update_prices_task
 from .models import Order
+from .price_list_services.mail_metrics import MAIL_METRICS_FILE
 
 from celery.result import AsyncResult
 from pathlib import Path
@@ -70,6 +71,20 @@ def download_prices(request):
         raise Http404(e)
 
 
+def mail_metrics(request):
+    """Метрики последнего обхода почты для Prometheus; включается MAIL_METRICS_ENDPOINT=1."""
+    if os.getenv("MAIL_METRICS_ENDPOINT") != "1":
+        raise Http404("Метрики почты отключены")
+
+    file_path = BASE_DIR / os.getenv("SAVE_DIR", "saved_prices") / MAIL_METRICS_FILE
+    if not file_path.exists():
+        raise Http404("Почта ещё не обновлялась")
+    return HttpResponse(
+        file_path.read_text(encoding="utf-8"),
+        content_type="text/plain; version=0.0.4; charset=utf-8",
+    )
+
+
 @staff_member_required
 def admin_order_detail(request, order_id):
     order = get_object_or_404(Order, id=order_id)